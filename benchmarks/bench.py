@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+'''
+Offline benchmarks of the OLED and WS2812 drivers, the daemon tick and the
+system status collectors, run against the simulator backend of backends.py
+
+Usage:
+    python3 benchmarks/bench.py [-r ROUNDS] [-o FILE] [-c BASELINE] [NAME ...]
+
+Only the benchmarks whose name starts with one of the NAMEs are run.  The
+results are printed as JSON, or written to FILE, and compared with the
+BASELINE results of a previous run if given.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from configparser import ConfigParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'pi4'))
+
+import backends
+
+simulator = backends.get_backend('simulator')
+
+
+class Skip(Exception):
+    pass
+
+
+benchmarks = []
+
+def benchmark(name):
+    '''
+    Register a setup function returning the operation to time
+    '''
+    def decorator(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+
+def setup_work_dir():
+    '''
+    Run the daemon on the simulator backend, in a temporary PI4_DIR holding
+    config.txt and the font
+    '''
+    if 'PI4_DIR' not in os.environ:
+        work_dir = tempfile.mkdtemp(prefix='pi4_bench_')
+        config = ConfigParser()
+        config.read(os.path.join(ROOT, 'config.txt'))
+        config['all']['backend'] = 'simulator'
+        config['all']['metrics_port'] = '0'
+        with open(os.path.join(work_dir, 'config.txt'), 'w') as f:
+            config.write(f)
+        shutil.copy(os.path.join(ROOT, 'pi4', 'Minecraftia-Regular.ttf'), work_dir)
+        os.environ['PI4_DIR'] = work_dir
+
+    import utils
+    utils.logger.stdout = False
+    utils.logger.capture_stderr = lambda: None
+    # No sudo, modprobe or lsb_release off-device
+    utils.run_command = lambda cmd: (1, '')
+
+    import system_status
+    try:
+        system_status.get_cpu_temperature()
+    except (KeyError, AttributeError):
+        system_status.get_cpu_temperature = lambda: 45.0
+
+
+def stats_image():
+    from PIL import Image, ImageDraw
+    image = Image.new('1', (128, 64))
+    draw = ImageDraw.Draw(image)
+    draw.pieslice((0, 12, 30, 42), start=180, end=300, fill=1, outline=1)
+    draw.rectangle((40, 29, 100, 39), outline=1, fill=1)
+    draw.text((40, 17), 'RAM:  1.2/3.8 G', fill=1)
+    draw.text((40, 41), 'DISK: 12.5/29.1 G', fill=1)
+    return image
+
+
+def make_oled(transport):
+    from oled import SSD1306_128_64
+    oled = SSD1306_128_64(i2c=simulator.i2c(transport=transport))
+    oled.begin()
+    return oled
+
+
+@benchmark('oled.image')
+def bench_oled_image():
+    from i2c import I2C
+    oled = make_oled(I2C.RDWR)
+    image = stats_image()
+    return lambda: oled.image(image)
+
+def bench_oled_display_full(transport):
+    oled = make_oled(transport)
+    oled.image(stats_image())
+    return lambda: oled.display(force_full=True)
+
+@benchmark('oled.display.full.smbus')
+def bench_oled_display_full_smbus():
+    return bench_oled_display_full('smbus')
+
+@benchmark('oled.display.full.rdwr')
+def bench_oled_display_full_rdwr():
+    return bench_oled_display_full('rdwr')
+
+@benchmark('oled.display.dirty')
+def bench_oled_display_dirty():
+    from i2c import I2C
+    from PIL import ImageDraw
+    oled = make_oled(I2C.RDWR)
+    images = [stats_image(), stats_image()]
+    ImageDraw.Draw(images[1]).text((2, 27), '42.0 %', fill=1)
+    oled.image(images[0])
+    oled.display()
+    state = {'frame': 0}
+
+    def op():
+        state['frame'] ^= 1
+        oled.image(images[state['frame']])
+        oled.display()
+    return op
+
+
+def font_path():
+    return os.path.join(os.environ['PI4_DIR'], 'Minecraftia-Regular.ttf')
+
+@benchmark('text.pil')
+def bench_text_pil():
+    from PIL import Image, ImageDraw, ImageFont
+    font = ImageFont.truetype(font_path(), 8)
+    draw = ImageDraw.Draw(Image.new('1', (128, 64)))
+    return lambda: draw.text((40, 41), 'DISK: 12.5/29.1 G', font=font, fill=1)
+
+@benchmark('text.atlas')
+def bench_text_atlas():
+    import glyphs
+    atlas = glyphs.atlas(font_path(), 8)
+    buffer = bytearray(128 * 8)
+    return lambda: atlas.text(buffer, 128, 40, 41, 'DISK: 12.5/29.1 G')
+
+
+@benchmark('screen.update')
+def bench_screen_update():
+    from PIL import ImageFont
+    from stats_screen import StatsScreen
+    from system_status import SystemStatus
+    screen = StatsScreen(ImageFont.truetype(font_path(), 8))
+    statuses = [SystemStatus(), SystemStatus()]
+    for status, load in zip(statuses, (25, 75)):
+        status.cpu_temp = 40 + load / 5
+        status.cpu_usage = load
+        status.ram_total, status.ram_used, status.ram_percent = 3.7, 3.7 * load / 100, load
+        status.disk_total, status.disk_used, status.disk_percent = 29.1, 29.1 * load / 100, load
+        status.ip = '192.168.1.%d' % load
+    state = {'frame': 0}
+
+    # Every region changes on every frame
+    def op():
+        state['frame'] ^= 1
+        screen.render(statuses[state['frame']])
+    return op
+
+
+@benchmark('screen.gauge')
+def bench_screen_gauge():
+    from PIL import ImageFont
+    from stats_screen import StatsScreen
+    screen = StatsScreen(ImageFont.truetype(font_path(), 8))
+    state = {'level': 0}
+
+    # A usage moving between a few states, as usual, drawn from the cache
+    def op():
+        state['level'] = (state['level'] + 45) % 180
+        screen.cpu_gauge.draw(screen.canvas, state['level'])
+    return op
+
+
+def rgb_benchmarks():
+    from ws2812_RGB import RGB_styles, WS2812, compile_animation, hex_to_rgb
+    color = tuple(hex_to_rgb('ee55ee'))
+    order = tuple(WS2812.lights_order)
+    for style in RGB_styles:
+        def bench_compile(style=style):
+            return lambda: compile_animation.__wrapped__(style, color, 50, 16, order)
+
+        def bench_frame(style=style):
+            strip = WS2812(LED_COUNT=16, LED_PIN=10, LED_BRIGHTNESS=25,
+                           strip_class=simulator.pixel_strip)
+            animation = strip.compile(style, list(color), 50)
+            strip.write_frame(animation.frames[0])
+            state = {'index': 0}
+
+            # One incremental frame, as shown by WS2812.play()
+            def op():
+                index = state['index'] = (state['index'] + 1) % len(animation)
+                for led, color in animation.changes[index]:
+                    strip.strip.setPixelColor(led, color)
+                strip.strip.show()
+            return op
+
+        benchmark('rgb.compile.%s' % style)(bench_compile)
+        benchmark('rgb.frame.%s' % style)(bench_frame)
+
+
+def status_benchmarks():
+    import system_status
+    for name in ('get_cpu_usage', 'get_ram_info', 'get_disk_info', 'getIP'):
+        benchmark('status.%s' % name)(lambda name=name: getattr(system_status, name))
+
+    @benchmark('status.collect')
+    def bench_collect():
+        # Every metric due on every call
+        snapshot = system_status.SystemSnapshot(
+            intervals={name: 0 for name in system_status.SystemSnapshot.INTERVALS})
+        return snapshot.collect
+
+
+@benchmark('main.tick')
+def bench_main_tick():
+    import main
+    if not main.oled_ok:
+        raise Skip('oled init failed')
+    main.screen_always_on = True
+
+    def op():
+        main.update_status()
+        if main.fan_ok:
+            main.fan_control()
+        main.oled_control()
+    op()
+    return op
+
+
+def run(setup, rounds):
+    op = setup()
+    for _ in range(min(rounds, 10)):
+        op()
+    for recorder in backends.recorders.values():
+        recorder.reset()
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        op()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    result = {
+        'rounds': rounds,
+        'mean_ms': sum(times) / rounds * 1000,
+        'min_ms': times[0] * 1000,
+        'p50_ms': times[rounds // 2] * 1000,
+        'p90_ms': times[int(rounds * 0.9)] * 1000,
+        'max_ms': times[-1] * 1000,
+    }
+    # Per call traffic to the simulated devices
+    for kind, recorder in backends.recorders.items():
+        summary = recorder.summary()
+        if summary['calls']:
+            result[kind + '_calls'] = summary['calls'] / rounds
+            result[kind + '_bytes'] = summary['bytes'] / rounds
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print('%-32s %10s %10s %8s' % ('benchmark', 'base ms', 'new ms', 'ratio'), file=sys.stderr)
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or 'mean_ms' not in base or 'mean_ms' not in result:
+            continue
+        print('%-32s %10.3f %10.3f %7.2fx' % (name, base['mean_ms'], result['mean_ms'],
+              result['mean_ms'] / base['mean_ms']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pi4 offline benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmark name prefixes')
+    parser.add_argument('-r', '--rounds', type=int, default=200)
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+    parser.add_argument('-c', '--compare', help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    setup_work_dir()
+    rgb_benchmarks()
+    status_benchmarks()
+
+    results = {}
+    for name, setup in benchmarks:
+        if args.names and not any(name.startswith(prefix) for prefix in args.names):
+            continue
+        try:
+            results[name] = run(setup, args.rounds)
+        except Skip as e:
+            results[name] = {'skipped': str(e)}
+        print('%-32s %s' % (name, '%.3f ms' % results[name]['mean_ms']
+              if 'mean_ms' in results[name] else results[name]['skipped']), file=sys.stderr)
+
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+'''
+Compare system_status.getIP() (psutil, in-process) with the ifconfig based
+getIP_ifconfig() it replaced
+
+Usage:
+    python3 benchmarks/getip.py [rounds]
+'''
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pi4'))
+
+from system_status import getIP, getIP_ifconfig
+
+
+def bench(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func()
+    return (time.perf_counter() - start) / rounds, result
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    t_new, IPs_new = bench(getIP, rounds)
+    t_old, IPs_old = bench(getIP_ifconfig, rounds)
+
+    print(f'interfaces: {len(IPs_new)}')
+    print(f'getIP()          {t_new*1000:8.3f} ms/call')
+    print(f'getIP_ifconfig() {t_old*1000:8.3f} ms/call')
+    print(f'speedup          {t_old/t_new:8.1f} x')
+    if IPs_new != IPs_old:
+        print(f'results differ:\n  getIP():          {IPs_new}\n  getIP_ifconfig(): {IPs_old}')
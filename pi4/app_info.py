@@ -8,4 +8,8 @@ try:
 except:
     username = os.popen("echo ${SUDO_USER:-$(who -m | awk '{ print $1 }')}").readline().strip()
 
-config_file = f'/opt/{__app_name__}/config.txt'
+# Installation directory, PI4_DIR overrides it to run off-device
+work_dir = os.environ.get('PI4_DIR', f'/opt/{__app_name__}')
+
+config_file = f'{work_dir}/config.txt'
+timing_file = f'{work_dir}/timing'
@@ -0,0 +1,361 @@
+import os
+import sys
+import threading
+
+from i2c import I2C
+from oled import (SSD1306_COLUMNADDR, SSD1306_PAGEADDR, SSD1306_DISPLAYON,
+                  SSD1306_DISPLAYOFF, SSD1306_MEMORYMODE)
+
+
+class Recorder():
+    '''
+    Calls and bytes written, per method name
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.bytes = 0
+
+    def record(self, name, size=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.bytes += size
+
+    def summary(self):
+        return {'calls': sum(self.calls.values()), 'bytes': self.bytes}
+
+
+# What the simulated devices were given, shared by all of them
+recorders = {
+    'i2c': Recorder(),
+    'ws2812': Recorder(),
+    'gpio': Recorder(),
+}
+
+
+class SimBus():
+    '''
+    I2C bus with the SMBus and RdwrBus methods, every device answers
+    '''
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder or recorders['i2c']
+
+    def _write(self, addr, data):
+        pass
+
+    def write_quick(self, addr):
+        self.recorder.record('write_quick')
+
+    def write_byte(self, addr, data):
+        self.recorder.record('write_byte', 1)
+        self._write(addr, [data])
+
+    def write_byte_data(self, addr, reg, data):
+        self.recorder.record('write_byte_data', 2)
+        self._write(addr, [reg, data])
+
+    def write_word_data(self, addr, reg, data):
+        self.recorder.record('write_word_data', 3)
+        self._write(addr, [reg, data & 0xFF, (data >> 8) & 0xFF])
+
+    def write_i2c_block_data(self, addr, reg, data):
+        self.recorder.record('write_i2c_block_data', 1 + len(data))
+        self._write(addr, [reg] + list(data))
+
+    def write(self, addr, data):
+        self.recorder.record('write', len(data))
+        self._write(addr, list(data))
+
+    def read_byte(self, addr):
+        self.recorder.record('read_byte')
+        return 0
+
+    def read(self, addr, num):
+        self.recorder.record('read')
+        return [0] * num
+
+    def read_i2c_block_data(self, addr, reg, num):
+        self.recorder.record('read_i2c_block_data', 1)
+        return [0] * num
+
+    def close(self):
+        pass
+
+
+class VirtualSSD1306Bus(SimBus):
+    '''
+    I2C bus with an emulated SSD1306 128x64 on it, in horizontal addressing
+    mode.  Each frame, on flush(), is rendered to a PNG file or, when output
+    is 'terminal', to stdout with half block characters
+    '''
+    # Argument bytes of the multi-byte commands
+    ARGS = {
+        SSD1306_COLUMNADDR: 2, SSD1306_PAGEADDR: 2, SSD1306_MEMORYMODE: 1,
+        0x81: 1, 0xA8: 1, 0xD3: 1, 0xD5: 1, 0xD9: 1, 0xDA: 1, 0xDB: 1, 0x8D: 1,
+    }
+
+    def __init__(self, output='terminal', width=128, height=64, recorder=None):
+        super().__init__(recorder)
+        self.output = output
+        self.width = width
+        self.pages = height // 8
+        self.ram = bytearray(width * self.pages)
+        self.is_on = False
+        self._window = [0, width - 1, 0, self.pages - 1]
+        self._col = 0
+        self._page = 0
+        self._command = []   # command waiting for its arguments
+        self._changed = True
+        self._lock = threading.Lock()
+
+    def _write(self, addr, data):
+        if not data:
+            return
+        control, data = data[0], data[1:]
+        with self._lock:
+            if control & 0x40:
+                self._data(data)
+            else:
+                for byte in data:
+                    self._command_byte(byte)
+
+    def _command_byte(self, byte):
+        self._command.append(byte)
+        if len(self._command) <= self.ARGS.get(self._command[0], 0):
+            return
+        command, self._command = self._command, []
+        if command[0] == SSD1306_COLUMNADDR:
+            self._window[0:2] = command[1:3]
+            self._col = command[1]
+        elif command[0] == SSD1306_PAGEADDR:
+            self._window[2:4] = command[1:3]
+            self._page = command[1]
+        elif command[0] in (SSD1306_DISPLAYON, SSD1306_DISPLAYOFF):
+            self.is_on = command[0] == SSD1306_DISPLAYON
+            self._changed = True
+
+    def _data(self, data):
+        col_start, col_end, page_start, page_end = self._window
+        for byte in data:
+            self.ram[self._page * self.width + self._col] = byte
+            self._col += 1
+            if self._col > col_end:
+                self._col = col_start
+                self._page += 1
+                if self._page > page_end:
+                    self._page = page_start
+        self._changed = True
+
+    def flush(self):
+        with self._lock:
+            if not self._changed:
+                return
+            self._changed = False
+            ram = bytes(self.ram) if self.is_on else bytes(len(self.ram))
+        if self.output == 'terminal':
+            self.render_terminal(ram)
+        else:
+            self.render_png(ram)
+
+    def pixel(self, ram, x, y):
+        return ram[(y // 8) * self.width + x] >> (y % 8) & 1
+
+    def render_terminal(self, ram):
+        lines = ['\x1b[H']
+        for y in range(0, self.pages * 8, 2):
+            lines.append(''.join(' ▀▄█'[self.pixel(ram, x, y) | self.pixel(ram, x, y+1) << 1]
+                                 for x in range(self.width)))
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+    def render_png(self, ram):
+        from PIL import Image
+        height = self.pages * 8
+        pixels = bytes(255 if self.pixel(ram, x, y) else 0
+                       for y in range(height) for x in range(self.width))
+        image = Image.frombytes('L', (self.width, height), pixels).convert('1')
+        # Replace the file at once, for the viewers reloading it
+        image.save(self.output + '.tmp', format='PNG')
+        os.replace(self.output + '.tmp', self.output)
+
+
+class SimPixelStrip():
+    '''
+    rpi_ws281x.PixelStrip holding the colors in memory
+    '''
+
+    def __init__(self, num, pin, freq_hz=800000, dma=10, invert=False,
+                 brightness=255, channel=0, strip_type=None, gamma=None, recorder=None):
+        self.recorder = recorder or recorders['ws2812']
+        self.pixels = [0] * num
+        self.brightness = brightness
+
+    def begin(self):
+        self.recorder.record('begin')
+
+    def show(self):
+        # 24 bits per LED on the wire
+        self.recorder.record('show', 3 * len(self.pixels))
+
+    def setPixelColor(self, n, color):
+        self.recorder.record('setPixelColor')
+        self.pixels[n] = color
+
+    def setBrightness(self, brightness):
+        self.recorder.record('setBrightness')
+        self.brightness = brightness
+
+    def getPixelColor(self, n):
+        return self.pixels[n]
+
+    def numPixels(self):
+        return len(self.pixels)
+
+
+class SimOutputDevice():
+    '''
+    gpiozero.DigitalOutputDevice holding its value
+    '''
+
+    def __init__(self, pin, recorder=None):
+        self.recorder = recorder or recorders['gpio']
+        self.pin = pin
+        self.value = 0
+
+    @property
+    def is_active(self):
+        return bool(self.value)
+
+    def on(self):
+        self.recorder.record('on')
+        self.value = 1
+
+    def off(self):
+        self.recorder.record('off')
+        self.value = 0
+
+    def close(self):
+        pass
+
+
+class SimInputDevice():
+    '''
+    gpiozero.DigitalInputDevice pulled down, press() and release() drive it
+    low and high as the power key does
+    '''
+
+    def __init__(self, pin, pull_up=False, bounce_time=None, recorder=None):
+        self.recorder = recorder or recorders['gpio']
+        self.pin = pin
+        self.value = 1
+        self.when_activated = None
+        self.when_deactivated = None
+
+    @property
+    def is_active(self):
+        return bool(self.value)
+
+    def press(self):
+        self.value = 0
+        if self.when_deactivated is not None:
+            self.when_deactivated()
+
+    def release(self):
+        self.value = 1
+        if self.when_activated is not None:
+            self.when_activated()
+
+    def close(self):
+        pass
+
+
+class Backend():
+    '''
+    Builds the I2C bus, the LED strip and the GPIO devices of the daemon,
+    options are backend specific
+    '''
+    name = None
+
+    def __init__(self, **options):
+        self.options = options
+
+    def i2c(self, bus=1, transport=I2C.SMBUS):
+        raise NotImplementedError
+
+    def pixel_strip(self, *args, **kargs):
+        raise NotImplementedError
+
+    def output_device(self, pin):
+        raise NotImplementedError
+
+    def input_device(self, pin, pull_up=False, bounce_time=None):
+        raise NotImplementedError
+
+
+class HardwareBackend(Backend):
+    name = 'hardware'
+
+    def i2c(self, bus=1, transport=I2C.SMBUS):
+        return I2C(bus=bus, transport=transport)
+
+    def pixel_strip(self, *args, **kargs):
+        from rpi_ws281x import PixelStrip
+        return PixelStrip(*args, **kargs)
+
+    def output_device(self, pin):
+        from gpiozero import DigitalOutputDevice
+        return DigitalOutputDevice(pin)
+
+    def input_device(self, pin, pull_up=False, bounce_time=None):
+        from gpiozero import DigitalInputDevice
+        return DigitalInputDevice(pin, pull_up=pull_up, bounce_time=bounce_time)
+
+
+class SimulatorBackend(Backend):
+    '''
+    Devices doing nothing but recording what they are given, in recorders
+    '''
+    name = 'simulator'
+
+    def i2c(self, bus=1, transport=I2C.SMBUS):
+        return I2C(bus=bus, transport=transport, smbus=SimBus())
+
+    def pixel_strip(self, *args, **kargs):
+        return SimPixelStrip(*args, **kargs)
+
+    def output_device(self, pin):
+        return SimOutputDevice(pin)
+
+    def input_device(self, pin, pull_up=False, bounce_time=None):
+        return SimInputDevice(pin, pull_up, bounce_time)
+
+
+class VirtualBackend(SimulatorBackend):
+    '''
+    Simulator with the OLED rendered to options['display'], a PNG file or
+    'terminal'
+    '''
+    name = 'virtual'
+
+    def i2c(self, bus=1, transport=I2C.SMBUS):
+        display = self.options.get('display') or 'terminal'
+        return I2C(bus=bus, transport=transport, smbus=VirtualSSD1306Bus(display))
+
+
+_backends = {}
+
+def register(cls):
+    _backends[cls.name] = cls
+    return cls
+
+for _cls in (HardwareBackend, SimulatorBackend, VirtualBackend):
+    register(_cls)
+
+def get_backend(name, **options):
+    '''
+    Return a new backend registered as name, KeyError if there is none
+    '''
+    return _backends[name](**options)
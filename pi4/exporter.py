@@ -0,0 +1,150 @@
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class Metric():
+    '''
+    One metric family of the OpenMetrics exposition: name, type (gauge,
+    counter or histogram), help, unit and its samples as (suffix, labels,
+    value), labels being a dict.  Counter samples get the _total suffix
+    '''
+    __slots__ = ('name', 'type', 'help', 'unit', 'samples')
+
+    def __init__(self, name, type, help, unit=None):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, **labels):
+        if value is not None:
+            suffix = '_total' if self.type == 'counter' else ''
+            self.samples.append((suffix, labels, value))
+        return self
+
+    def add_histogram(self, histogram, **labels):
+        '''
+        Add the samples of a timing.Histogram
+        '''
+        total = 0
+        for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            self.samples.append(('_bucket', dict(labels, le=le), total))
+        self.samples.append(('_count', labels, total))
+        self.samples.append(('_sum', labels, histogram.sum))
+        return self
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def render(metrics):
+    '''
+    Return metrics, a list of Metric, in the OpenMetrics text format
+    '''
+    lines = []
+    for metric in metrics:
+        if not metric.samples:
+            continue
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        if metric.unit:
+            lines.append('# UNIT %s %s' % (metric.name, metric.unit))
+        lines.append('# HELP %s %s' % (metric.name, _escape(metric.help)))
+        for suffix, labels, value in metric.samples:
+            if labels:
+                labels = '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels.items())
+            else:
+                labels = ''
+            value = str(value) if isinstance(value, int) else repr(float(value))
+            lines.append('%s%s%s %s' % (metric.name, suffix, labels, value))
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+class MetricsExporter():
+    '''
+    Serves the metrics returned by collect() on http://host:port/metrics.
+
+    collect() is called on every scrape and must only read values already
+    collected by the daemon, never the hardware.  The server runs either in
+    a thread, start(), or as a coroutine of the asyncio runtime, serve()
+    '''
+
+    def __init__(self, collect, port=9101, host='127.0.0.1'):
+        self.collect = collect
+        self.port = port
+        self.host = host
+        self._server = None
+
+    def render(self):
+        return render(self.collect()).encode()
+
+    def _response(self, path):
+        '''
+        Return status, content type and body of a GET request for path
+        '''
+        if path.split('?')[0] != '/metrics':
+            return 404, 'text/plain', b'Not Found\n'
+        try:
+            return 200, CONTENT_TYPE, self.render()
+        except Exception as e:
+            return 500, 'text/plain', ('%s\n' % e).encode()
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                code, content_type, body = exporter._response(self.path)
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name='exporter', daemon=True)
+        thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    async def serve(self):
+        '''
+        Serve until cancelled
+        '''
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                code, content_type, body = 405, 'text/plain', b'Method Not Allowed\n'
+            else:
+                code, content_type, body = self._response(parts[1])
+            reason = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed'}.get(code, 'Error')
+            writer.write(('HTTP/1.0 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                          % (code, reason, content_type, len(body))).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
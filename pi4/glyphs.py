@@ -0,0 +1,188 @@
+'''
+Bitmap glyph atlas of a TrueType font at one size, to draw text straight
+into an SSD1306 page-format buffer without going through FreeType.
+
+The glyphs are rasterized once with PIL and kept as columns of pixel bits.
+Text is then drawn glyph by glyph, each at the sum of the advances before
+it, which is how ImageDraw.text() lays out a pixel font such as Minecraftia
+at size 8.  It is not at every size: at 12, PIL places glyphs on a
+fractional pen and some land a column further.  The layout is checked when
+the atlas is built, and fonts and sizes laid out otherwise are refused.
+
+The atlas is cached next to the font, in <font>.<size>.atlas, and rebuilt
+when the font file changes.  Characters missing from the atlas are added
+on first use.
+'''
+import os
+import json
+
+ATLAS_VERSION = 1
+# Printable ASCII, all the daemon shows
+CHARSET = ''.join(chr(c) for c in range(32, 127))
+
+
+class GlyphAtlas():
+    '''
+    Glyphs of the font at path and size: per character its advance and
+    its pixel columns as (dx, bits), bit n being the pixel n rows below
+    the text position.  ValueError if PIL does not lay the font out glyph
+    by glyph
+    '''
+
+    def __init__(self, path, size, charset=CHARSET):
+        self.path = path
+        self.size = size
+        self.cache_file = '%s.%d.atlas' % (path, size)
+        self._font = None
+        self._glyphs = {}
+        self._packed = {}   # (char, y % 8) -> advance, [(dx, page, byte)]
+        if not self._load():
+            for char in charset:
+                self._glyphs[char] = self._rasterize(char)
+            self._check([charset] + [char * 4 for char in charset])
+            self._save()
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+            if data['version'] != ATLAS_VERSION or data['font'] != self._stamp():
+                return False
+            self._glyphs = {char: (advance, [tuple(column) for column in columns])
+                            for char, (advance, columns) in data['glyphs'].items()}
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def _save(self):
+        '''
+        Write the cache, skipped when the font directory is read-only
+        '''
+        data = {
+            'version': ATLAS_VERSION,
+            'font': self._stamp(),
+            'size': self.size,
+            'glyphs': {char: [advance, columns] for char, (advance, columns) in self._glyphs.items()},
+        }
+        try:
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError:
+            pass
+
+    def _rasterize(self, char):
+        from PIL import Image, ImageDraw, ImageFont
+        if self._font is None:
+            self._font = ImageFont.truetype(self.path, self.size)
+        advance = self._font.getlength(char)
+        left, top, right, bottom = self._font.getbbox(char)
+        columns = []
+        if right > left and bottom > top:
+            # Room for glyphs reaching left of the text position
+            pad = max(0, -left)
+            image = Image.new('1', (right + pad, bottom))
+            ImageDraw.Draw(image).text((pad, 0), char, font=self._font, fill=1)
+            pixels = image.load()
+            for x in range(image.width):
+                bits = 0
+                for y in range(image.height):
+                    if pixels[x, y]:
+                        bits |= 1 << y
+                if bits:
+                    columns.append((x - pad, bits))
+        return advance, columns
+
+    def _glyph(self, char):
+        try:
+            return self._glyphs[char]
+        except KeyError:
+            glyph = self._glyphs[char] = self._rasterize(char)
+            try:
+                self._check([char * 4])
+            except ValueError:
+                del self._glyphs[char]
+                raise
+            self._save()
+            return glyph
+
+    def _pack(self, char, shift):
+        '''
+        Return the advance of char and its columns shifted down by shift
+        rows, as (dx, page, byte) for every non zero byte
+        '''
+        advance, columns = self._glyph(char)
+        packed = []
+        for dx, bits in columns:
+            bits <<= shift
+            page = 0
+            while bits:
+                if bits & 0xFF:
+                    packed.append((dx, page, bits & 0xFF))
+                bits >>= 8
+                page += 1
+        self._packed[char, shift] = advance, packed
+        return advance, packed
+
+    def _check(self, texts):
+        '''
+        Raise ValueError unless each of texts drawn glyph by glyph equals
+        the text drawn by ImageDraw.text()
+        '''
+        from PIL import Image, ImageDraw
+        from oled import pack_image
+        for text in texts:
+            left, top, right, bottom = self._font.getbbox(text)
+            # Room for glyphs reaching left of the text position
+            width = (right + 16) // 8 * 8
+            height = (bottom + 7) // 8 * 8
+            image = Image.new('1', (width, height))
+            ImageDraw.Draw(image).text((8, 0), text, font=self._font, fill=1)
+            buffer = bytearray(width * height // 8)
+            self.text(buffer, width, 8, 0, text)
+            if buffer != pack_image(image.tobytes(), width, height):
+                raise ValueError('%s at size %d is not laid out glyph by glyph: %r'
+                                 % (self.path, self.size, text))
+
+    def text(self, buffer, width, x, y, text, fill=1):
+        '''
+        Draw text at x, y into buffer, a page format buffer width pixels
+        wide, lighting the pixels of the glyphs if fill else clearing them.
+        Return the x after the text
+        '''
+        pages = len(buffer) // width
+        page0, shift = divmod(y, 8)
+        packed = self._packed
+        pen = x
+        for char in text:
+            try:
+                advance, columns = packed[char, shift]
+            except KeyError:
+                advance, columns = self._pack(char, shift)
+            left = round(pen)
+            for dx, page, byte in columns:
+                col = left + dx
+                page += page0
+                if 0 <= col < width and 0 <= page < pages:
+                    if fill:
+                        buffer[page*width + col] |= byte
+                    else:
+                        buffer[page*width + col] &= ~byte
+            pen += advance
+        return pen
+
+
+_atlases = {}
+
+def atlas(path, size):
+    '''
+    Return the GlyphAtlas of the font at path and size, shared
+    '''
+    try:
+        return _atlases[path, size]
+    except KeyError:
+        return _atlases.setdefault((path, size), GlyphAtlas(path, size))
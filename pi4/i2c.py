@@ -1,15 +1,136 @@
-from smbus import SMBus
+import os
+import time
+import errno
+import ctypes
+import fcntl
+# Only needed by the smbus transport
+try:
+    from smbus import SMBus
+except ImportError:
+    SMBus = None
+from timing import timer, histogram
+
+# i2c-dev ioctl and message flag, see <linux/i2c-dev.h> and <linux/i2c.h>
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+_write_block_time = histogram('i2c.write_block')
+
+
+class _I2CMsg(ctypes.Structure):
+    _fields_ = [
+        ('addr', ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len', ctypes.c_uint16),
+        ('buf', ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class _I2CRdwrData(ctypes.Structure):
+    _fields_ = [
+        ('msgs', ctypes.POINTER(_I2CMsg)),
+        ('nmsgs', ctypes.c_uint32),
+    ]
+
+
+class RdwrBus():
+    """Raw /dev/i2c-N bus driven by the I2C_RDWR ioctl.  Provides the SMBus
+    methods used by I2C, without the 32 byte block limit: a whole message of
+    up to MAX_LEN bytes goes out in a single ioctl.
+    """
+    MAX_LEN = 8192   # I2C_RDWR per message limit of the kernel
+
+    def __init__(self, bus):
+        self._fd = os.open('/dev/i2c-%d' % bus, os.O_RDWR)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _transfer(self, *msgs):
+        """Run msgs, a list of (addr, flags, ctypes buffer or None), as one
+        combined transaction with repeated starts between messages."""
+        items = (_I2CMsg * len(msgs))()
+        for item, (addr, flags, buf) in zip(items, msgs):
+            item.addr = addr
+            item.flags = flags
+            if buf is not None:
+                item.len = len(buf)
+                item.buf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))
+        data = _I2CRdwrData(items, len(msgs))
+        fcntl.ioctl(self._fd, I2C_RDWR, data)
+
+    def write(self, addr, data):
+        data = bytes(data)
+        if len(data) > self.MAX_LEN:
+            raise ValueError("I2C message too long: %d > %d" % (len(data), self.MAX_LEN))
+        buf = (ctypes.c_uint8 * len(data)).from_buffer_copy(data) if data else None
+        self._transfer((addr, 0, buf))
+
+    def read(self, addr, num):
+        buf = (ctypes.c_uint8 * num)()
+        self._transfer((addr, I2C_M_RD, buf))
+        return list(buf)
+
+    def write_quick(self, addr):
+        return self.write(addr, b'')
+
+    def write_byte(self, addr, data):
+        return self.write(addr, [data])
+
+    def write_byte_data(self, addr, reg, data):
+        return self.write(addr, [reg, data])
+
+    def write_word_data(self, addr, reg, data):
+        return self.write(addr, [reg, data & 0xFF, (data >> 8) & 0xFF])
+
+    def write_i2c_block_data(self, addr, reg, data):
+        return self.write(addr, [reg] + list(data))
+
+    def read_byte(self, addr):
+        return self.read(addr, 1)[0]
+
+    def read_i2c_block_data(self, addr, reg, num):
+        reg_buf = (ctypes.c_uint8 * 1)(reg)
+        buf = (ctypes.c_uint8 * num)()
+        self._transfer((addr, 0, reg_buf), (addr, I2C_M_RD, buf))
+        return list(buf)
 
 
 class I2C():
     MASTER = 0
     SLAVE  = 1
     RETRY = 5
+    SCAN_TTL = 10   # Seconds a bus scan result stays valid
 
-    def __init__(self, *args, **kargs):     
+    # Transports
+    SMBUS = 'smbus'   # smbus.SMBus, block writes of at most 32 bytes
+    RDWR = 'rdwr'     # RdwrBus, raw I2C_RDWR messages
+
+    def __init__(self, *args, bus=1, transport=SMBUS, smbus=None, **kargs):
+        """smbus, an object with the SMBus methods, replaces the bus opened
+        for transport, e.g. a simulated one from backends."""
         super().__init__()
-        self._bus = 1
-        self._smbus = SMBus(self._bus)
+        self._bus = bus
+        self.transport = transport
+        if transport == self.SMBUS:
+            if smbus is None:
+                if SMBus is None:
+                    raise ImportError('smbus is required by the smbus transport.')
+                smbus = SMBus(self._bus)
+            # Max data bytes per _i2c_write_i2c_block_data call
+            self.block_size = 32
+        elif transport == self.RDWR:
+            if smbus is None:
+                smbus = RdwrBus(self._bus)
+            self.block_size = RdwrBus.MAX_LEN - 1
+        else:
+            raise ValueError("Unknown I2C transport: {}".format(transport))
+        self._smbus = smbus
+        # address -> True for the devices found by the last scan
+        self._scan_cache = None
+        self._scan_time = 0
 
     def _i2c_write_byte(self, addr, data):
         return self._smbus.write_byte(addr, data)
@@ -21,7 +142,8 @@ class I2C():
         return self._smbus.write_word_data(addr, reg, data)
 
     def _i2c_write_i2c_block_data(self, addr, reg, data):
-        return self._smbus.write_i2c_block_data(addr, reg, data)
+        with timer(_write_block_time):
+            return self._smbus.write_i2c_block_data(addr, reg, data)
 
     def _i2c_read_byte(self, addr):
         return self._smbus.read_byte(addr)
@@ -29,30 +151,44 @@ class I2C():
     def _i2c_read_i2c_block_data(self, addr, reg, num):
         return self._smbus.read_i2c_block_data(addr, reg, num)
 
-    def is_ready(self, addr):
-        addresses = self.scan()
-        if addr in addresses:
+    def _i2c_probe(self, addr):
+        """Return whether a device answers at addr, probing like i2cdetect:
+        read byte in the EEPROM ranges, quick write everywhere else."""
+        try:
+            if 0x30 <= addr <= 0x37 or 0x50 <= addr <= 0x5F:
+                self._smbus.read_byte(addr)
+            else:
+                self._smbus.write_quick(addr)
             return True
-        else:
-            return False
-
-    def scan(self):
-        cmd = "i2cdetect -y %s" % self._bus
-        _, output = self.run_command(cmd)
+        except OSError as e:
+            # Claimed by a kernel driver, shown as UU by i2cdetect.
+            return e.errno == errno.EBUSY
 
-        outputs = output.split('\n')[1:]                        
-        addresses = []
-        for tmp_addresses in outputs:
-            if tmp_addresses == "":
-                continue
-            tmp_addresses = tmp_addresses.split(':')[1]
-            tmp_addresses = tmp_addresses.strip().split(' ')
+    def flush(self):
+        """Called by the drivers once a whole frame is written, for the buses
+        acting on frames rather than single writes."""
+        flush = getattr(self._smbus, 'flush', None)
+        if flush is not None:
+            flush()
 
-            for address in tmp_addresses:
-                if address != '--':
-                    addresses.append(int(address, 16))
-
-        return addresses
+    def is_ready(self, addr):
+        return addr in self._scan()
+
+    def invalidate_scan(self):
+        """Drop the cached scan result, the next scan() probes the bus."""
+        self._scan_cache = None
+
+    def _scan(self, refresh=False):
+        now = time.monotonic()
+        if refresh or self._scan_cache is None or now - self._scan_time > self.SCAN_TTL:
+            self._scan_cache = {addr: True for addr in range(0x03, 0x78) if self._i2c_probe(addr)}
+            self._scan_time = now
+        return self._scan_cache
+
+    def scan(self, refresh=False):
+        """Return the addresses of the devices on the bus.  The result is
+        cached for SCAN_TTL seconds unless refresh is True."""
+        return list(self._scan(refresh))
 
     def send(self, send, addr, timeout=0):
         if isinstance(send, bytearray):
@@ -1,19 +1,27 @@
 import os
 import sys
 import time
-import threading
 import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from gpiozero import InputDevice
-from gpiozero import DigitalOutputDevice as Fan
 from configparser import ConfigParser
 from PIL import Image,ImageDraw,ImageFont
 from oled import SSD1306_128_64
+from i2c import I2C
 
 from system_status import *
-from utils import log, run_command
-from app_info import __app_name__, __version__, username, config_file
-from ws2812_RGB import WS2812, RGB_styles
+from utils import log, run_command, logger, LEVELS
+from app_info import __app_name__, __version__, username, work_dir, config_file, timing_file
+from ws2812_RGB import WS2812, RGB_styles, RGBController
+from power_key import PowerKey
+from stats_screen import StatsScreen
+from scheduler import Scheduler
+import timing
+from timing import timer
+from exporter import MetricsExporter, Metric
+from backends import get_backend
 
 
 # Print system information
@@ -43,7 +51,16 @@ if status == 0:
 power_key_pin = 16
 fan_pin = 6
 rgb_pin = 10
-update_frequency = 0.5 # Second
+status_period = 0.25 # Second, cpu temperature and usage
+fan_period = 1 # Second
+disk_period = 30 # Second
+oled_fps = 2 # oled refresh per second
+runtime = 'thread' # 'thread' or 'asyncio', how the duties are run
+config_watch_period = 2 # Second, asyncio runtime only
+metrics_port = 9101 # OpenMetrics endpoint, 0 to disable
+metrics_host = '127.0.0.1' # '0.0.0.0' to allow remote scrapes
+backend_name = 'hardware' # 'hardware', 'simulator' or 'virtual'
+virtual_display = '%s/oled.png'%work_dir # PNG file or 'terminal', virtual backend only
 
 temp_unit = 'F' # 'F' or 'C'
 fan_temp = 90 # Fahrenheit
@@ -55,17 +72,21 @@ rgb_style = 'breath'
 rgb_color = 'ee55ee'
 rgb_blink_speed = 50
 rgb_pwm_freq = 1000 # kHz
+rgb_fps = 60 # max frames per second of the rgb animations
+log_level = 'DEBUG' # DEBUG, INFO, WARNING or ERROR
+log_max_size = 1024 # KB, size at which the log is rotated
+log_backup_count = 5 # number of gzipped logs kept
 
 temp_lower_set = 2
 
 config = ConfigParser()
 if not os.path.exists(config_file):
-    log('Configuration file does not exist, recreating ...')
+    log('Configuration file does not exist, recreating ...', level='WARNING')
 
     status, result = run_command(
         cmd=f'sudo touch {config_file}' + f' && sudo chmod 774 {config_file}')
     if status != 0:
-        log('create config_file failed:\n%s'%result)
+        log('create config_file failed:\n%s'%result, level='ERROR')
         raise Exception(result)
 
 try:
@@ -89,9 +110,19 @@ try:
     rgb_blink_speed = int(config['all']['rgb_blink_speed'])
     rgb_pwm_freq = int(config['all']['rgb_pwm_freq'])
     rgb_pin = int(config['all']['rgb_pin'])
+    rgb_fps = int(config['all'].get('rgb_fps', rgb_fps))
+    log_level = str(config['all'].get('log_level', log_level))
+    log_max_size = int(config['all'].get('log_max_size', log_max_size))
+    log_backup_count = int(config['all'].get('log_backup_count', log_backup_count))
+    oled_fps = float(config['all'].get('oled_fps', oled_fps))
+    runtime = str(config['all'].get('runtime', runtime))
+    metrics_port = int(config['all'].get('metrics_port', metrics_port))
+    metrics_host = str(config['all'].get('metrics_host', metrics_host))
+    backend_name = str(config['all'].get('backend', backend_name))
+    virtual_display = str(config['all'].get('virtual_display', virtual_display))
 
 except Exception as e:
-    log(f"read config error: {e}")
+    log(f"read config error: {e}", level='ERROR')
     config['all'] ={
         'temp_unit':temp_unit,
         'fan_temp':fan_temp,
@@ -104,13 +135,33 @@ except Exception as e:
         'rgb_blink_speed':rgb_blink_speed,
         'rgb_pwm_freq':rgb_pwm_freq,
         'rgb_pin':rgb_pin,
+        'rgb_fps':rgb_fps,
+        'log_level':log_level,
+        'log_max_size':log_max_size,
+        'log_backup_count':log_backup_count,
+        'oled_fps':oled_fps,
+        'runtime':runtime,
+        'metrics_port':metrics_port,
+        'metrics_host':metrics_host,
+        'backend':backend_name,
+        'virtual_display':virtual_display,
         }
     with open(config_file, 'w') as f:
         config.write(f)
 
+if oled_fps <= 0:
+    log('oled_fps must be above 0, use default value: 2', level='WARNING')
+    oled_fps = 2
+if rgb_fps <= 0:
+    log('rgb_fps must be above 0, use default value: 60', level='WARNING')
+    rgb_fps = 60
+
 log("power_key_pin : %s"%power_key_pin)
 log("fan_pin : %s"%fan_pin)
-log("update_frequency : %s"%update_frequency)
+log("status_period : %s"%status_period)
+log("fan_period : %s"%fan_period)
+log("disk_period : %s"%disk_period)
+log("oled_fps : %s"%oled_fps)
 log("temp_unit : %s"%temp_unit)
 log("fan_temp : %s"%fan_temp)
 log("screen_always_on : %s"%screen_always_on)
@@ -122,7 +173,27 @@ log("rgb_color : %s"%rgb_color)
 log("rgb_blink_speed : %s"%rgb_blink_speed)
 log("rgb_pwm_freq : %s"%rgb_pwm_freq)
 log("rgb_pin : %s"%rgb_pin)
+log("rgb_fps : %s"%rgb_fps)
+log("log_level : %s"%log_level)
+log("log_max_size : %s"%log_max_size)
+log("log_backup_count : %s"%log_backup_count)
+# Select the runtime for a single run, ig: python3 main.py asyncio
+if 'asyncio' in sys.argv:
+    runtime = 'asyncio'
+log("runtime : %s"%runtime)
+log("metrics_port : %s"%metrics_port)
+log("metrics_host : %s"%metrics_host)
+log("backend : %s"%backend_name)
+log("virtual_display : %s"%virtual_display)
 log(">>>", timestamp=False)
+logger.level = LEVELS.get(log_level, LEVELS['DEBUG'])
+
+# Hardware backend, the simulated ones run without a Pi
+try:
+    backend = get_backend(backend_name, display=virtual_display)
+except KeyError:
+    log('backend not in backends, use hardware', level='WARNING')
+    backend = get_backend('hardware')
 
 # rgb_strip init
 try:
@@ -132,22 +203,17 @@ try:
         LED_FREQ_HZ=rgb_pwm_freq*1000,
         # led_brightness * 225 / 100 = led_brightness (range 0-255)
         LED_BRIGHTNESS=int(led_brightness*255/100) if int(led_brightness*255/100) > 0 else 1, # ig: 10 * 255 / 100 = 25.5 
+        fps=rgb_fps,
+        strip_class=backend.pixel_strip,
     )
     log(f'rgb_strip init success')
 except Exception as e:
-    log('rgb_strip init failed:\n%s'%e)
+    log('rgb_strip init failed:\n%s'%e, level='ERROR')
     strip = None
 
-def rgb_show():
-    log('rgb_show')
-    try:
-        if rgb_style in RGB_styles:
-            log('rgb_show: %s'%rgb_style)
-            strip.display(style=rgb_style, color=rgb_color, speed=rgb_blink_speed)
-        else:
-            log('rgb_style not in RGB_styles')
-    except Exception as e:
-        log(e,level='rgb_strip')
+rgb = None
+if strip != None:
+    rgb = RGBController(strip, style=rgb_style, color=rgb_color, speed=rgb_blink_speed)
 
 # Close rgb
 if 'close_rgb' in sys.argv:
@@ -157,53 +223,54 @@ if 'close_rgb' in sys.argv:
         strip.clear()
     sys.exit(0)
 
+# Only the daemon rotates the log, stderr, redirected to the log file by
+# bin/pi4, then follows the rotation
+logger.max_size = log_max_size * 1024
+logger.backup_count = log_backup_count
+logger.capture_stderr()
+
 # Fan io init
 fan_ok = False
 try:
-    fan = Fan(fan_pin)
+    fan = backend.output_device(fan_pin)
     fan_ok = True
     log('fan init success')
 except Exception as e:
     fan_ok = False
-    log(f'fan init failed:\n {e}')
+    log(f'fan init failed:\n {e}', level='ERROR')
 
 # Powerkey io init
 power_key_ok = False
 try:
-    power_key = InputDevice(power_key_pin, pull_up=False)
+    power_key = PowerKey(power_key_pin, hold_time=2,
+                         device=backend.input_device(power_key_pin, pull_up=False, bounce_time=0.01))
     power_key_ok = True
     log('power_key init success')
 except Exception as e:
     power_key_ok = False
-    log(f'power_key init failed:\n {e}')
-
-# Get IP
-def getIPAddress():
-    ip = None
-    IPs = getIP()
-
-    log("Got IPs: %s" %IPs)
-    if 'wlan0' in IPs and IPs['wlan0'] != None and IPs['wlan0'] != '':
-        ip = IPs['wlan0']
-    elif 'eth0' in IPs and IPs['eth0'] != None and IPs['eth0'] != '':
-        ip = IPs['eth0']
-    elif len(IPs.keys()) > 0:
-        interface = list(IPs.keys())[0]
-        if IPs[interface] != None and IPs[interface] != '':
-            ip = IPs[list(IPs.keys())[0]]
-        else:
-            ip = 'DISCONNECT'
-    else:
-        ip = 'DISCONNECT'
+    log(f'power_key init failed:\n {e}', level='ERROR')
+
+# IP watcher, falls back to polling getIP() if netlink is not available
+try:
+    ip_watcher = IPWatcher()
+    ip_watcher.start()
+    log('ip_watcher init success')
+except Exception as e:
+    ip_watcher = None
+    log(f'ip_watcher init failed:\n {e}', level='ERROR')
 
-    return ip
+# System status collector
+snapshot = SystemSnapshot(intervals={'disk': disk_period}, ip_watcher=ip_watcher)
 
 # Oled init
 oled_ok = False
 oled_stat = False
+oled_lock = threading.Lock() # main loop and power key callbacks share the oled
+time_start = time.time() # when the screen was turned on
 try:
-    run_command("sudo modprobe i2c-dev")
-    oled = SSD1306_128_64()
+    if backend.name == 'hardware':
+        run_command("sudo modprobe i2c-dev")
+    oled = SSD1306_128_64(i2c=backend.i2c(transport=I2C.RDWR))
     width = oled.width
     height = oled.height
     oled.begin()
@@ -212,21 +279,64 @@ try:
 
     image = Image.new('1', (width, height))
     draw = ImageDraw.Draw(image)
-    font_8 = ImageFont.truetype('/opt/%s/Minecraftia-Regular.ttf'%__app_name__, 8)
-    font_12 = ImageFont.truetype('/opt/%s/Minecraftia-Regular.ttf'%__app_name__, 12)
+    font_8 = ImageFont.truetype('%s/Minecraftia-Regular.ttf'%work_dir, 8)
+    font_12 = ImageFont.truetype('%s/Minecraftia-Regular.ttf'%work_dir, 12)
 
-    def draw_text(text, x, y, fill=1):
-        text = str(text)
-        draw.text((x, y), text=text, font=font_8, fill=fill)
+    # Static background drawn once, the values redrawn when they change
+    stats_screen = StatsScreen(font_8, temp_unit)
 
     oled_ok = True
     oled_stat = True
     log('oled init success')
 except Exception as e:
-    log('oled init failed:\n%s'%e)
+    log('oled init failed:\n%s'%e, level='ERROR')
     oled_ok = False
     oled_stat = False
 
+# Power key handlers, called from the gpiozero threads
+def on_power_key_pressed():
+    global oled_stat, time_start
+    # Screen on
+    with oled_lock:
+        if oled_ok and oled_stat == False:
+            oled.on()
+            oled_stat = True
+        time_start = time.time()
+
+def on_power_key_held():
+    global oled_stat, last_frame_key
+    # Power off
+    if oled_ok:
+        with oled_lock:
+            oled.on()
+            draw.rectangle((0, 0, width, height), outline=0, fill=0)
+            left, top, right, bottom = font_12.getbbox('POWER OFF')
+            text_width = right - left
+            text_height = bottom - top
+            text_x = int((width - text_width)/2-1)
+            text_y = int((height - text_height)/2-1)
+            draw.text((text_x, text_y), text='POWER OFF', font=font_12, fill=1)
+            oled.image(image)
+            oled.display()
+            stats_screen.invalidate()
+            last_frame_key = None
+
+    power_key.wait_for_release()
+    log("POWER OFF")
+
+    if oled_ok:
+        with oled_lock:
+            oled_stat = False
+            oled.off()
+
+    os.system('poweroff')
+    # Clean up through the signal handler of the main thread
+    os.kill(os.getpid(), signal.SIGTERM)
+
+if power_key_ok:
+    power_key.when_pressed = on_power_key_pressed
+    power_key.when_held = on_power_key_held
+
 # Exit handler
 def exit_handler():
     try:
@@ -241,217 +351,331 @@ def exit_handler():
         fan.close() # Release gpio resource
         # RGB off
         if strip != None:
+            rgb.close()
             strip.clear()
             time.sleep(0.2)
         sys.exit(0)
     except:
         pass
 
+# Reload the rgb settings from config_file, applied without restarting
+def reload_rgb_config():
+    global rgb_enable, led_brightness, rgb_style, rgb_color, rgb_blink_speed
+
+    try:
+        config.read(config_file)
+        _rgb_enable = config['all']['rgb_enable'] != 'False'
+        _led_brightness = int(config['all']['led_brightness'])
+        _rgb_style = str(config['all']['rgb_style'])
+        _rgb_color = str(config['all']['rgb_color'])
+        _rgb_blink_speed = int(config['all']['rgb_blink_speed'])
+    except Exception as e:
+        log(f"reload config error: {e}", level='ERROR')
+        return
+    if rgb == None:
+        return
+    if _rgb_style not in RGB_styles:
+        log('rgb_style not in RGB_styles', level='WARNING')
+        _rgb_style = rgb_style
+    if _led_brightness != led_brightness:
+        led_brightness = _led_brightness
+        log("led_brightness : %s"%led_brightness)
+        rgb.set_brightness(int(led_brightness*255/100) if int(led_brightness*255/100) > 0 else 1)
+    if _rgb_style != rgb_style:
+        rgb_style = _rgb_style
+        log("rgb_style : %s"%rgb_style)
+        rgb.set_style(rgb_style)
+    if _rgb_color != rgb_color:
+        rgb_color = _rgb_color
+        log("rgb_color : %s"%rgb_color)
+        rgb.set_color(rgb_color)
+    if _rgb_blink_speed != rgb_blink_speed:
+        rgb_blink_speed = _rgb_blink_speed
+        log("rgb_blink_speed : %s"%rgb_blink_speed)
+        rgb.set_speed(rgb_blink_speed)
+    if _rgb_enable != rgb_enable:
+        rgb_enable = _rgb_enable
+        log("rgb_enable : %s"%rgb_enable)
+        if rgb_enable:
+            rgb.resume()
+        else:
+            rgb.stop()
+
+# Log the timing histograms and write them to timing_file, for pi4 -t
+def dump_timing():
+    text = timing.dump()
+    text += '\noled frames drawn: %d, skipped as unchanged: %d'%(oled_frames, oled_skipped_frames)
+    log("Timing (ms):\n%s"%text)
+    try:
+        with open(timing_file, 'w') as f:
+            f.write(text + '\n')
+    except OSError as e:
+        log(f'write timing_file failed: {e}', level='ERROR')
+
 def signal_handler(signo, frame):
     if signo == signal.SIGTERM or signo == signal.SIGINT:
         log("Received SIGTERM or SIGINT signal. Cleaning up...")
         exit_handler()
+    elif signo == signal.SIGHUP:
+        log("Received SIGHUP signal. Reloading rgb config ...")
+        reload_rgb_config()
+    elif signo == signal.SIGUSR1:
+        dump_timing()
 
 # Register signal handlers
 signal.signal(signal.SIGTERM, signal_handler)
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGHUP, signal_handler)
+signal.signal(signal.SIGUSR1, signal_handler)
+
+# Status of the system, updated by update_status()
+status = None
+last_ip = 'DISCONNECT'
+fan_state = False
+scheduler = None
+draw_time = timing.histogram('oled.draw')
+last_frame_key = None # values of the frame on the screen
+oled_frames = 0 # frames drawn
+oled_skipped_frames = 0 # frames not drawn, the values being unchanged
+
+def update_status():
+    global status, last_ip
+
+    # Get system status data, each metric at its own refresh interval
+    status = snapshot.collect()
+    if last_ip != status.ip:
+        last_ip = status.ip
+        log("Got IPs: %s" %status.ips)
+        log("Get IP: %s" %status.ip)
+
+def fan_control():
+    global fan_state
+
+    # Get CPU temperature
+    CPU_temp_C = status.cpu_temp # celcius
+    CPU_temp_F = float(CPU_temp_C * 1.8 + 32) # fahrenheit
+
+    if temp_unit == 'F':
+        if CPU_temp_F > fan_temp:
+            fan.on()
+        elif CPU_temp_F < fan_temp - temp_lower_set*1.8:
+            fan.off()
+    elif temp_unit == 'C':
+        if CPU_temp_C > fan_temp:
+            fan.on()
+        elif CPU_temp_C < fan_temp - temp_lower_set:
+            fan.off()
+    else:
+        log('temp_unit error, use defalut value: 90\'F', level='WARNING')
+        if CPU_temp_F > 90:
+            fan.on()
+        elif CPU_temp_F < 88:
+            fan.off()
+    fan_state = fan.is_active
+
+def oled_control():
+    global oled_stat, last_frame_key, oled_frames, oled_skipped_frames
+
+    with oled_lock:
+        if oled_stat != True:
+            return
+
+        # The values as shown, skip the frame if none changed
+        values = stats_screen.values(status)
+        key = tuple(values.values())
+        if key == last_frame_key:
+            oled_skipped_frames += 1
+        else:
+            last_frame_key = key
+            oled_frames += 1
+            # Redraw the regions of the screen whose value changed
+            with timer(draw_time):
+                boxes = stats_screen.update(values)
+            # Draw the screen buffer
+            if boxes:
+                oled.set_buffer(stats_screen.canvas.buffer)
+            oled.display()
+        # Ccreen off timer
+        if screen_always_on == False and (time.time()-time_start) > screen_off_time:
+            oled.off()
+            oled_stat = False
 
-# Main
-def main():
-    global fan_temp, power_key_pin, screen_off_time, rgb_color, rgb_pin
-    global oled_stat, screen_always_on
-
-    ip = 'DISCONNECT'
-    last_ip = 'DISCONNECT'
+# Start rgb and the screen timer, common to both runtimes
+def setup():
+    global screen_always_on, time_start
 
     time_start = time.time()
-    power_key_flag = False
-    power_timer = 0
+
+    # Without power key the screen could not be turned back on
+    if power_key_ok != True:
+        screen_always_on = True
+        if oled_ok:
+            oled.on()
 
     # Start rgb_thread
     if strip != None:
-        if rgb_enable:
-            rgb_thread = threading.Thread(target=rgb_show)
-            rgb_thread.daemon = True
-            rgb_thread.start()
-        else:
-            strip.clear()
+        if rgb_enable and rgb_style not in RGB_styles:
+            log('rgb_style not in RGB_styles', level='WARNING')
+        rgb.start(playing=rgb_enable and rgb_style in RGB_styles)
     else:
-        log('rgb_strip is None')
+        log('rgb_strip is None', level='WARNING')
+
+# Each duty runs at its own rate, update_status first. The blocking ones,
+# psutil reads and I2C transfers, run in the executor of the asyncio runtime
+def make_scheduler():
+    scheduler = Scheduler()
+    scheduler.add('status', status_period, update_status, blocking=True)
+    if fan_ok:
+        scheduler.add('fan', fan_period, fan_control)
+    if oled_ok:
+        scheduler.add('oled', 1/oled_fps, oled_control, blocking=True)
+    return scheduler
+
+# Metrics for the exporter, from the values already collected, so that
+# scrapes never read the hardware
+def collect_metrics():
+    metrics = []
+    _status = status
+    if _status is not None:
+        metrics += [
+            Metric('pi4_cpu_temperature_celsius', 'gauge', 'CPU temperature', 'celsius').add(_status.cpu_temp),
+            Metric('pi4_cpu_usage_ratio', 'gauge', 'CPU usage', 'ratio').add(_status.cpu_usage / 100),
+            Metric('pi4_memory_total_bytes', 'gauge', 'Total RAM', 'bytes').add(_status.ram_total * 2**30),
+            Metric('pi4_memory_used_bytes', 'gauge', 'Used RAM', 'bytes').add(_status.ram_used * 2**30),
+            Metric('pi4_disk_total_bytes', 'gauge', 'Size of the root filesystem', 'bytes').add(_status.disk_total * 2**30),
+            Metric('pi4_disk_used_bytes', 'gauge', 'Used space of the root filesystem', 'bytes').add(_status.disk_used * 2**30),
+            Metric('pi4_status_age_seconds', 'gauge', 'Age of the collected status', 'seconds').add(time.monotonic() - _status.time),
+        ]
+    if fan_ok:
+        metrics.append(Metric('pi4_fan_on', 'gauge', 'Whether the fan is on').add(int(fan_state)))
+    if oled_ok:
+        metrics += [
+            Metric('pi4_oled_on', 'gauge', 'Whether the screen is on').add(int(oled_stat)),
+            Metric('pi4_oled_frames', 'counter', 'Screen refreshes drawn').add(oled_frames),
+            Metric('pi4_oled_skipped_frames', 'counter', 'Screen refreshes skipped as unchanged').add(oled_skipped_frames),
+        ]
+    if strip != None:
+        rgb_stats = strip.scheduler.stats()
+        metrics += [
+            Metric('pi4_rgb_fps', 'gauge', 'Average frames per second of the rgb animations').add(rgb_stats['fps']),
+            Metric('pi4_rgb_frames', 'counter', 'Frames shown on the rgb strip').add(rgb_stats['frames']),
+            Metric('pi4_rgb_dropped_frames', 'counter', 'Frames of the rgb animations dropped as late').add(rgb_stats['dropped']),
+        ]
+    if scheduler is not None:
+        runs = Metric('pi4_task_runs', 'counter', 'Runs of the daemon duties')
+        overruns = Metric('pi4_task_overruns', 'counter', 'Runs longer than the period of the duty')
+        skipped = Metric('pi4_task_skipped', 'counter', 'Periods skipped because the duty was late')
+        run_time = Metric('pi4_task_run_seconds', 'counter', 'Time spent in the duties', 'seconds')
+        max_time = Metric('pi4_task_max_run_seconds', 'gauge', 'Longest run of the duties', 'seconds')
+        max_late = Metric('pi4_task_max_latency_seconds', 'gauge', 'Longest start delay of the duties', 'seconds')
+        for name, task in list(scheduler.tasks.items()):
+            runs.add(task.runs, task=name)
+            overruns.add(task.overruns, task=name)
+            skipped.add(task.skipped, task=name)
+            run_time.add(task.total_time, task=name)
+            max_time.add(task.max_time, task=name)
+            max_late.add(task.max_late, task=name)
+        metrics += [runs, overruns, skipped, run_time, max_time, max_late]
+    stages = Metric('pi4_stage_seconds', 'histogram', 'Time spent in the stages of the daemon and drivers', 'seconds')
+    for name, hist in sorted(timing.histograms.items()):
+        stages.add_histogram(hist, stage=name)
+    metrics.append(stages)
+    return metrics
+
+def make_exporter():
+    if metrics_port <= 0:
+        return None
+    return MetricsExporter(collect_metrics, port=metrics_port, host=metrics_host)
 
-    # Main loop
+# Main
+def main():
+    global scheduler
+
+    setup()
+    scheduler = make_scheduler()
+    exporter = make_exporter()
+    if exporter != None:
+        try:
+            exporter.start()
+            log('metrics exporter init success')
+        except OSError as e:
+            log(f'metrics exporter init failed:\n {e}', level='ERROR')
+    scheduler.run()
+
+# Reload the rgb config when config_file changes
+async def watch_config():
+    def mtime():
+        try:
+            return os.stat(config_file).st_mtime
+        except OSError:
+            return None
+
+    last_mtime = mtime()
     while True:
-        # Get CPU temperature
-        CPU_temp_C = float(get_cpu_temperature()) # celcius
-        CPU_temp_F = float(CPU_temp_C * 1.8 + 32) # fahrenheit
-
-        # Fan control
-        if fan_ok:
-            if temp_unit == 'F':
-                if CPU_temp_F > fan_temp:
-                    fan.on()
-                elif CPU_temp_F < fan_temp - temp_lower_set*1.8:
-                    fan.off()
-            elif temp_unit == 'C':
-                if CPU_temp_C > fan_temp:
-                    fan.on()
-                elif CPU_temp_C < fan_temp - temp_lower_set:
-                    fan.off()
-            else:
-                log('temp_unit error, use defalut value: 90\'F')
-                if CPU_temp_F > 90:
-                    fan.on()
-                elif CPU_temp_F < 88:
-                    fan.off()
-
-        # Oled control
-        if oled_ok and oled_stat == True:
-            # Get system status data
-            CPU_usage = float(get_cpu_usage())
-
-            # Clear the image buffer
-            draw.rectangle((0, 0, width, height), outline=0, fill=0)
-            # Get RAM and disk info
-            ram_info = get_ram_info()
-            ram_total = round(ram_info['total'], 1)
-            ram_used = round(ram_info['used'], 1)
-            ram_percent = round(ram_info['percent'], 1)
-            # Disk info
-            disk_info = get_disk_info()
-            disk_total = disk_info['total']
-            disk_used = disk_info['used']
-            disk_percent = disk_info['percent']
-
-            disk_unit = 'G1'
-            if disk_total >= 1000:
-                disk_unit = 'T'
-                disk_total = round(disk_total/1000, 3)
-                disk_used = round(disk_used/1000, 3)
-            elif disk_total >= 100:
-                disk_unit = 'G2'
-
-            # Get IP address if disconnected
-            ip = getIPAddress()
-            if last_ip != ip:
-                last_ip = ip
-                log("Get IP: %s" %ip)
-
-            # Display info
-            ip_rect = Rect(40, 0, 87, 10)
-            ram_info_rect = Rect(40, 17, 87, 10)
-            ram_rect = Rect(40, 29, 87, 10)
-            rom_info_rect = Rect(40, 41, 87, 10)
-            rom_rect = Rect(40, 53, 87, 10)
-            # CPU usage
-            draw_text('CPU',6,0)
-            draw.pieslice((0, 12, 30, 42), start=180, end=0, fill=0, outline=1)
-            draw.pieslice((0, 12, 30, 42), start=180, end=int(180+180*CPU_usage*0.01), fill=1, outline=1)
-            draw_text('{:^5.1f} %'.format(CPU_usage), 2, 27)
-            # CPU temperature
-            if temp_unit == 'F':
-                draw_text('{:>4.1f} \'F'.format(CPU_temp_F),2,38)
-                draw.pieslice((0, 33, 30, 63), start=0, end=180, fill=0, outline=1)
-                pcent = (CPU_temp_F-32)/1.8
-                draw.pieslice((0, 33, 30, 63), start=int(180-180*pcent*0.01), end=180, fill=1, outline=1)
-            elif temp_unit == 'C':
-                draw_text('{:>4.1f} \'C'.format(CPU_temp_C),2,38)
-                draw.pieslice((0, 33, 30, 63), start=0, end=180, fill=0, outline=1)
-                draw.pieslice((0, 33, 30, 63), start=int(180-180*CPU_temp_C*0.01), end=180, fill=1, outline=1)
-            # RAM
-            draw_text(f'RAM:  {ram_used:^4.1f}/{ram_total:^4.1f} G',*ram_info_rect.coord())
-            draw.rectangle(ram_rect.rect(), outline=1, fill=0)
-            draw.rectangle(ram_rect.rect(ram_percent), outline=1, fill=1)
-            # Disk
-            if disk_unit == 'G1':
-                _dec = 1
-                if disk_used < 10:
-                    _dec = 2              
-                draw_text(f'DISK: {disk_used:>2.{_dec}f}/{disk_total:<2.1f} G', *rom_info_rect.coord())
-            elif disk_unit == 'G2':
-                _dec = 0
-                if disk_used < 100:
-                    _dec = 1
-                draw_text(f'DISK: {disk_used:>3.{_dec}f}/{disk_total:<3.0f} G', *rom_info_rect.coord())
-            elif disk_unit == 'T':
-                draw_text(f'DISK: {disk_used:>2.2f}/{disk_total:<2.2f} T', *rom_info_rect.coord())
-
-            draw.rectangle(rom_rect.rect(), outline=1, fill=0)
-            draw.rectangle(rom_rect.rect(disk_percent), outline=1, fill=1)
-            # IP
-            draw.rectangle((ip_rect.x-13, ip_rect.y, ip_rect.x+ip_rect.width, ip_rect.height), outline=1, fill=1)
-            draw.pieslice((ip_rect.x-25, ip_rect.y, ip_rect.x-3, ip_rect.height+10), start=270, end=0, fill=0, outline=0)
-            draw_text(ip, *ip_rect.coord(), 0)
-            # Draw the image buffer
-            oled.image(image)
-            oled.display()
-            # Ccreen off timer
-            if screen_always_on == False and (time.time()-time_start) > screen_off_time:
-                oled.off()
-                oled_stat = False
-
-        # Power key event
-        if power_key_ok != True:
-            screen_always_on = True
-            oled.on()
-        else:
-            if power_key.value == 0:
-                # Screen on
-                if oled_ok and oled_stat == False:
-                    oled.on()
-                    oled_stat = True
-                    time_start = time.time()
-                # Power off
-                if power_key_flag == False:
-                    power_key_flag = True
-                    power_timer = time.time()
-                elif (time.time()-power_timer) > 2:
-                    if oled_ok:
-                        oled.on()
-                        draw.rectangle((0, 0, width, height), outline=0, fill=0)
-                        left, top, right, bottom = font_12.getbbox('POWER OFF')
-                        text_width = right - left
-                        text_height = bottom - top
-                        text_x = int((width - text_width)/2-1)
-                        text_y = int((height - text_height)/2-1)
-                        draw.text((text_x, text_y), text='POWER OFF', font=font_12, fill=1)
-                        oled.image(image)
-                        oled.display()
-
-                    while power_key.value == 0:
-                        pass
-                    log("POWER OFF")
-
-                    if oled_ok:
-                        oled_stat = False
-                        oled.off()
-
-                    os.system('poweroff')
-                    sys.exit(1)
-            else:
-                power_key_flag = False
-
-        time.sleep(update_frequency)
-
-
-class Rect:
-    def __init__(self, x, y, width, height):
-        self.x = x
-        self.y = y
-        self.width = width
-        self.height = height
-        self.x2 = self.x + self.width
-        self.y2 = self.y + self.height
-
-    def coord(self):
-        return (self.x, self.y)
-    def rect(self, pecent=100):
-        return (self.x, self.y, self.x + int(self.width*pecent/100.0), self.y2)
+        await asyncio.sleep(config_watch_period)
+        _mtime = mtime()
+        if _mtime != last_mtime:
+            last_mtime = _mtime
+            log("config_file changed. Reloading rgb config ...")
+            reload_rgb_config()
+
+# Run the power key handlers, posted from the gpiozero threads, in executor
+async def handle_power_key(executor):
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    power_key.when_pressed = lambda: loop.call_soon_threadsafe(events.put_nowait, on_power_key_pressed)
+    power_key.when_held = lambda: loop.call_soon_threadsafe(events.put_nowait, on_power_key_held)
+    try:
+        while True:
+            handler = await events.get()
+            await loop.run_in_executor(executor, handler)
+    finally:
+        power_key.when_pressed = on_power_key_pressed
+        power_key.when_held = on_power_key_held
+
+async def serve_metrics(exporter):
+    try:
+        await exporter.serve()
+    except OSError as e:
+        log(f'metrics exporter init failed:\n {e}', level='ERROR')
+
+# Main, asyncio runtime. SIGTERM and SIGINT cancel it, the duties stop at
+# their next await and exit_handler() runs once the executor is idle
+async def async_main():
+    global scheduler
+
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for signo in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signo, main_task.cancel)
+    loop.add_signal_handler(signal.SIGHUP, reload_rgb_config)
+    loop.add_signal_handler(signal.SIGUSR1, dump_timing)
+
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='io')
+    try:
+        setup()
+        scheduler = make_scheduler()
+        await loop.run_in_executor(executor, update_status)
+        duties = [scheduler.run_async(executor), watch_config()]
+        if power_key_ok:
+            duties.append(handle_power_key(executor))
+        exporter = make_exporter()
+        if exporter != None:
+            duties.append(serve_metrics(exporter))
+        await asyncio.gather(*duties)
+    except asyncio.CancelledError:
+        log("Cancelled. Cleaning up...")
+    finally:
+        executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        if runtime == 'asyncio':
+            asyncio.run(async_main())
+        else:
+            main()
     except Exception as e:
-        log(f'error\n {e}')
+        log(f'error\n {e}', level='ERROR')
     finally:
         exit_handler()
@@ -23,8 +23,18 @@
 from __future__ import division
 import logging
 import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
 from i2c import I2C
-#import Adafruit_GPIO.SPI as SPI
+from timing import timer, histogram
+# Only needed to drive the display over SPI
+try:
+    import Adafruit_GPIO as GPIO
+    import Adafruit_GPIO.SPI as SPI
+except ImportError:
+    GPIO = None
+    SPI = None
 
 # Constants
 SSD1306_I2C_ADDRESS = 0x3C    # 011110+SA0+RW - 0x3C or 0x3D
@@ -63,27 +73,336 @@ SSD1306_LEFT_HORIZONTAL_SCROLL = 0x27
 SSD1306_VERTICAL_AND_RIGHT_HORIZONTAL_SCROLL = 0x29
 SSD1306_VERTICAL_AND_LEFT_HORIZONTAL_SCROLL = 0x2A
 
+_display_time = histogram('oled.display')
+_image_time = histogram('oled.image')
+
+
+def _build_pack_table():
+    """Build the 8x8 bit transposition table used by pack_image().
+
+    Entry [row][value] is the contribution of one row byte (8 horizontal
+    pixels, MSB is the leftmost pixel) to a block of 8 page-format column
+    bytes, packed little endian into a single integer: bit `row` of byte `n`
+    is set when pixel `n` of the row is lit.
+    """
+    table = []
+    for row in range(8):
+        entries = []
+        for value in range(256):
+            packed = 0
+            for col in range(8):
+                if value & (0x80 >> col):
+                    packed |= (1 << row) << (8 * col)
+            entries.append(packed)
+        table.append(entries)
+    return table
+
+_PACK_TABLE = _build_pack_table()
+
+
+def pack_image(data, width, height):
+    """Convert the raw bytes of a mode '1' image (Image.tobytes(), rows of
+    width/8 bytes, MSB first) to a page-major SSD1306 buffer.  The width must
+    be a multiple of 8.
+    """
+    stride = width // 8
+    pages = height // 8
+    buffer = bytearray(width * pages)
+    t0, t1, t2, t3, t4, t5, t6, t7 = _PACK_TABLE
+    index = 0
+    for page in range(pages):
+        base = page * 8 * stride
+        r0, r1, r2, r3, r4, r5, r6, r7 = [data[base+row*stride:base+(row+1)*stride]
+                                          for row in range(8)]
+        for x in range(stride):
+            block = (t0[r0[x]] | t1[r1[x]] | t2[r2[x]] | t3[r3[x]] |
+                     t4[r4[x]] | t5[r5[x]] | t6[r6[x]] | t7[r7[x]])
+            buffer[index:index+8] = block.to_bytes(8, 'little')
+            index += 8
+    return buffer
+
+
+# Per byte shifts of the page rows, for bytes.translate().
+_SHIFT_DOWN = [bytes((v << s) & 0xFF for v in range(256)) for s in range(8)]
+_SHIFT_UP = [bytes(v >> (8 - s) if s else 0 for v in range(256)) for s in range(8)]
+
+
+def _page_mask(page, y0, y1):
+    """Return the bits of the rows y0 to y1, included, on page."""
+    top = max(y0 - page*8, 0)
+    bottom = min(y1 - page*8, 7)
+    return (0xFF << top) & (0xFF >> (7 - bottom))
+
+
+class Sprite(object):
+    """1 bit image in page format, width columns by pages*8 rows.  data holds
+    the pixel bits, none outside mask, mask those the sprite covers; a
+    sprite without mask covers all its rows and is copied as is.
+    """
+
+    __slots__ = ('width', 'pages', 'data', 'mask')
+
+    def __init__(self, width, pages, data, mask=None):
+        self.width = width
+        self.pages = pages
+        self.data = bytes(data)
+        self.mask = None if mask is None else bytes(mask)
+
+
+class Canvas(object):
+    """Drawing surface over a bytearray in SSD1306 page format: byte x of page
+    p holds the pixels of column x, rows 8p to 8p+7, the LSB on top.  The
+    coordinates of the boxes are included, as with ImageDraw.rectangle().
+
+    Each page of a box is drawn at once, through the page bytes read as a
+    single integer, and full pages are written as plain slices.
+    """
+
+    def __init__(self, width, height, buffer=None):
+        self.width = width
+        self.height = height
+        self.pages = height//8
+        if buffer is None:
+            buffer = bytearray(width*self.pages)
+        elif len(buffer) != width*self.pages:
+            raise ValueError('Buffer must be {0} bytes.'.format(width*self.pages))
+        self.buffer = buffer
+
+    @classmethod
+    def from_image(cls, image):
+        """Return a canvas of a mode '1' image, its width a multiple of 8."""
+        width, height = image.size
+        return cls(width, height, pack_image(image.tobytes(), width, height))
+
+    def copy(self):
+        return Canvas(self.width, self.height, bytearray(self.buffer))
+
+    def _clip(self, box):
+        x0, y0, x1, y1 = box
+        return max(x0, 0), max(y0, 0), min(x1, self.width-1), min(y1, self.height-1)
+
+    def _apply(self, offset, count, clear, bits):
+        """Clear then set bits, integers of count little endian bytes, at
+        offset."""
+        old = int.from_bytes(self.buffer[offset:offset+count], 'little')
+        self.buffer[offset:offset+count] = ((old & ~clear) | bits).to_bytes(count, 'little')
+
+    def fill_rect(self, box, fill=1):
+        """Set, or clear if fill is 0, the pixels of box (x0, y0, x1, y1)."""
+        x0, y0, x1, y1 = self._clip(box)
+        if x0 > x1 or y0 > y1:
+            return
+        count = x1 - x0 + 1
+        for page in range(y0//8, y1//8 + 1):
+            offset = page*self.width + x0
+            mask = _page_mask(page, y0, y1)
+            if mask == 0xFF:
+                self.buffer[offset:offset+count] = (b'\xff' if fill else b'\x00')*count
+            else:
+                bits = int.from_bytes(bytes((mask,))*count, 'little')
+                self._apply(offset, count, bits, bits if fill else 0)
+
+    def pixel(self, x, y, fill=1):
+        self.fill_rect((x, y, x, y), fill)
+
+    def hline(self, x0, x1, y, fill=1):
+        self.fill_rect((x0, y, x1, y), fill)
+
+    def vline(self, x, y0, y1, fill=1):
+        self.fill_rect((x, y0, x, y1), fill)
+
+    def rect(self, box, outline=None, fill=None):
+        """Draw box as ImageDraw.rectangle() does, with a 1 pixel outline."""
+        x0, y0, x1, y1 = box
+        if fill is not None:
+            self.fill_rect(box, fill)
+        if outline is not None:
+            self.hline(x0, x1, y0, outline)
+            self.hline(x0, x1, y1, outline)
+            self.vline(x0, y0, y1, outline)
+            self.vline(x1, y0, y1, outline)
+
+    def bar(self, box, end):
+        """Draw a progress bar in box, filled up to column end."""
+        self.rect(box, outline=1, fill=0)
+        self.fill_rect((box[0], box[1], end, box[3]), 1)
+
+    def paste(self, canvas, box):
+        """Copy box (x0, y0, x1, y1), x1 and y1 excluded as with Image.paste(),
+        from canvas of the same size."""
+        x0, y0, x1, y1 = self._clip((box[0], box[1], box[2]-1, box[3]-1))
+        if x0 > x1 or y0 > y1:
+            return
+        count = x1 - x0 + 1
+        for page in range(y0//8, y1//8 + 1):
+            offset = page*self.width + x0
+            source = canvas.buffer[offset:offset+count]
+            mask = _page_mask(page, y0, y1)
+            if mask == 0xFF:
+                self.buffer[offset:offset+count] = source
+            else:
+                bits = int.from_bytes(bytes((mask,))*count, 'little')
+                self._apply(offset, count, bits, int.from_bytes(source, 'little') & bits)
+
+    def sprite(self, box, mask=None):
+        """Return the pixels of box (x0, y0, x1, y1), x1 and y1 excluded, as a
+        sprite to blit at x0 and the page boundary above y0, covering only
+        the pixels set on mask, a canvas of the same size, if given."""
+        x0, y0, x1, y1 = box
+        pages = range(y0//8, (y1 + 7)//8)
+        def rows(canvas):
+            return b''.join(canvas.buffer[page*self.width+x0:page*self.width+x1] for page in pages)
+        data = rows(self)
+        if mask is None:
+            return Sprite(x1 - x0, len(pages), data)
+        mask = rows(mask)
+        data = (int.from_bytes(data, 'little') & int.from_bytes(mask, 'little')).to_bytes(len(data), 'little')
+        return Sprite(x1 - x0, len(pages), data, mask)
+
+    def blit(self, sprite, x, y):
+        """Draw sprite with its top left corner at x, y.  A sprite without
+        mask on a page boundary is copied a page row at a time."""
+        start = max(x, 0)
+        end = min(x + sprite.width, self.width)
+        if start >= end:
+            return
+        count = end - start
+        page0, shift = divmod(y, 8)
+        rows = []
+        for page in range(sprite.pages):
+            offset = page*sprite.width + start - x
+            data = sprite.data[offset:offset+count]
+            mask = b'\xff'*count if sprite.mask is None else sprite.mask[offset:offset+count]
+            rows.append((data, mask))
+        if shift:
+            # Split each sprite page over two pages of the canvas.
+            down, up = _SHIFT_DOWN[shift], _SHIFT_UP[shift]
+            shifted = []
+            previous = (bytes(count), bytes(count))
+            for data, mask in rows + [(bytes(count), bytes(count))]:
+                shifted.append(tuple(
+                    (int.from_bytes(row.translate(down), 'little') |
+                     int.from_bytes(last.translate(up), 'little')).to_bytes(count, 'little')
+                    for row, last in zip((data, mask), previous)))
+                previous = (data, mask)
+            rows = shifted
+        for page, (data, mask) in enumerate(rows, page0):
+            if not 0 <= page < self.pages:
+                continue
+            offset = page*self.width + start
+            if sprite.mask is None and not shift:
+                self.buffer[offset:offset+count] = data
+            else:
+                self._apply(offset, count, int.from_bytes(mask, 'little'),
+                            int.from_bytes(data, 'little'))
+
+
+class Gauge(object):
+    """Shape growing with a level, such as a pie gauge, drawn from precomputed
+    masks.  levels[y][x] is the lowest level at which the pixel x, y of the
+    shape is lit, None if never; the shape is at x0, y0 on the canvas.
+
+    With a base canvas, the sprites hold the pixels of base under the shape
+    too and are drawn as plain copies of their pages.  The last cache_size
+    sprites drawn are kept.
+    """
+
+    def __init__(self, x0, y0, levels, base=None, cache_size=0):
+        self.x = x0
+        # The sprites start on the page boundary above y0.
+        self.y = y0 // 8 * 8
+        shift = y0 - self.y
+        height = len(levels) + shift
+        self.width = max(len(row) for row in levels)
+        self.pages = (height + 7) // 8
+        self._base = None
+        if base is not None:
+            self._base = base.sprite((self.x, self.y, self.x + self.width, self.y + self.pages*8))
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # level -> sprite, the last used at the end
+        # Per column, the levels at which pixels turn on and the column bits
+        # lit from each of them.
+        self._steps = []
+        for x in range(self.width):
+            lit = sorted((row[x], y + shift) for y, row in enumerate(levels)
+                         if x < len(row) and row[x] is not None)
+            steps, bits = [], 0
+            for level, y in lit:
+                bits |= 1 << y
+                if steps and steps[-1][0] == level:
+                    steps[-1] = (level, bits)
+                else:
+                    steps.append((level, bits))
+            self._steps.append(([level for level, bits in steps], [bits for level, bits in steps]))
+
+    def columns(self, level):
+        """Return the bits of each column of the shape at level."""
+        columns = []
+        for levels, bits in self._steps:
+            index = bisect_right(levels, level)
+            columns.append(bits[index-1] if index else 0)
+        return columns
+
+    def sprite(self, level):
+        """Return the shape at level as a sprite, setting its lit pixels or,
+        with a base, copying them over the base."""
+        sprite = self._cache.get(level)
+        if sprite is not None:
+            self._cache.move_to_end(level)
+            return sprite
+        columns = self.columns(level)
+        data = b''.join(bytes((bits >> 8*page) & 0xFF for bits in columns)
+                        for page in range(self.pages))
+        if self._base is None:
+            sprite = Sprite(self.width, self.pages, data, data)
+        else:
+            count = len(data)
+            data = (int.from_bytes(data, 'little') |
+                    int.from_bytes(self._base.data, 'little')).to_bytes(count, 'little')
+            sprite = Sprite(self.width, self.pages, data)
+        if self.cache_size:
+            self._cache[level] = sprite
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sprite
+
+    def draw(self, canvas, level):
+        canvas.blit(self.sprite(level), self.x, self.y)
+
 
 class SSD1306Base(object):
     """Base class for SSD1306-based OLED displays.  Implementors should subclass
     and provide an implementation for the _initialize function.
     """
 
+    # Unchanged columns allowed between two changed ones before display()
+    # splits them into separate windows; a new window costs 6 command bytes.
+    DIRTY_GAP = 6
+
     def __init__(self, width, height, dc=None, sclk=None, din=None, cs=None,
                  gpio=None, spi=None, i2c_bus=None, i2c_address=SSD1306_I2C_ADDRESS,
                  i2c=None):
         self._log = logging.getLogger('Adafruit_SSD1306.SSD1306Base')
         self._spi = None
-        self._i2c = I2C()
+        if i2c is None:
+            i2c = I2C(bus=1 if i2c_bus is None else i2c_bus)
+        self._i2c = i2c
         self.addr = i2c_address
         self.width = width
         self.height = height
         self._pages = height//8
-        self._buffer = [0]*(width*self._pages)
-        # Default to platform GPIO if not provided.
+        self._buffer = bytearray(width*self._pages)
+        # Copy of the last buffer sent to the display, None when unknown.
+        self._shadow = None
+        # Commands queued by command_batch(), None outside of a batch.
+        self._commands = None
         self._gpio = gpio
-        # if self._gpio is None:
-        #     self._gpio = GPIO.get_platform_gpio()
+        uses_spi = spi is not None or (sclk is not None and din is not None and cs is not None)
+        if uses_spi and GPIO is None:
+            raise ImportError('Adafruit_GPIO is required to use SPI.')
+        # Default to platform GPIO if not provided.
+        if uses_spi and self._gpio is None:
+            self._gpio = GPIO.get_platform_gpio()
         # Setup reset pin.
         if spi is not None:
             self._log.debug('Using hardware SPI')
@@ -116,14 +435,43 @@ class SSD1306Base(object):
 
     def write_command(self, c):
         """Send write_command byte to display."""
+        self.write_commands([c])
+
+    def write_commands(self, commands):
+        """Send a sequence of command bytes to display in one transaction."""
+        if self._commands is not None:
+            # Sent by the enclosing command_batch() block.
+            self._commands.extend(commands)
+            return
+        commands = list(commands)
+        if not commands:
+            return
         if self._spi is not None:
             # SPI write.
             self._gpio.set_low(self._dc)
-            self._spi.write([c])
+            self._spi.write(commands)
         else:
-            # I2C write.
+            # I2C write, a single control byte followed by all the commands.
             control = 0x00   # Co = 0, DC = 0
-            self._i2c._i2c_write_byte_data(self.addr, control, c)
+            block_size = self._i2c.block_size
+            for i in range(0, len(commands), block_size):
+                self._i2c._i2c_write_i2c_block_data(self.addr, control, commands[i:i+block_size])
+
+    @contextmanager
+    def command_batch(self):
+        """Context manager collecting the commands written inside it and
+        sending them with a single write_commands() on exit.
+        """
+        if self._commands is not None:
+            # Nested batch, the outer one sends.
+            yield
+            return
+        self._commands = []
+        try:
+            yield
+        finally:
+            commands, self._commands = self._commands, None
+        self.write_commands(commands)
 
     def write_data(self, c):
         """Send byte of data to display."""
@@ -140,36 +488,99 @@ class SSD1306Base(object):
         """Initialize display."""
         # Save vcc state.
         self._vccstate = vccstate
-        # Reset and initialize display.
-        self._initialize()
-        # Turn on the display.
-        self.on()
+        # Reset and initialize display, sending the whole command sequence
+        # as one transaction.
+        with self.command_batch():
+            self._initialize()
+            # Turn on the display.
+            self.on()
+        # Display RAM content is undefined after a reset.
+        self._shadow = None
 
 
     def on(self):
-        self.write_command(SSD1306_DISPLAYON)
+        self.write_commands([SSD1306_DISPLAYON])
 
     def off(self):
-        self.write_command(SSD1306_DISPLAYOFF)
-
-    def display(self):
-        """Write display buffer to physical display."""
-        self.write_command(SSD1306_COLUMNADDR)
-        self.write_command(0)              # Column start address. (0 = reset)
-        self.write_command(self.width-1)   # Column end address.
-        self.write_command(SSD1306_PAGEADDR)
-        self.write_command(0)              # Page start address. (0 = reset)
-        self.write_command(self._pages-1)  # Page end address.
+        self.write_commands([SSD1306_DISPLAYOFF])
+
+    def display(self, force_full=False):
+        """Write display buffer to physical display.  Only the windows that
+        changed since the last write are sent, unless force_full is True or
+        the display contents are unknown (e.g. right after begin()).
+        """
+        with timer(_display_time):
+            buffer = bytes(self._buffer)
+            if force_full or self._shadow is None:
+                windows = [(0, self._pages-1, 0, self.width-1)]
+            else:
+                windows = self._dirty_windows(buffer, self._shadow)
+            for page_start, page_end, col_start, col_end in windows:
+                self._write_window(buffer, page_start, page_end, col_start, col_end)
+            # Remember what the display RAM holds now.
+            self._shadow = buffer
+            if self._spi is None:
+                self._i2c.flush()
+
+    def _dirty_windows(self, buffer, shadow):
+        """Diff buffer against shadow and return the changed regions as a list
+        of [page_start, page_end, col_start, col_end] windows.  Changed columns
+        closer than DIRTY_GAP on a page are coalesced into one run, and equal
+        runs on consecutive pages are merged into a single window.
+        """
+        width = self.width
+        windows = []
+        previous = {}   # (col_start, col_end) -> window index, for the last page
+        for page in range(self._pages):
+            start = page*width
+            runs = []
+            if buffer[start:start+width] != shadow[start:start+width]:
+                for x in range(width):
+                    if buffer[start+x] != shadow[start+x]:
+                        if runs and x - runs[-1][1] <= self.DIRTY_GAP:
+                            runs[-1][1] = x
+                        else:
+                            runs.append([x, x])
+            current = {}
+            for col_start, col_end in runs:
+                key = (col_start, col_end)
+                if key in previous:
+                    index = previous[key]
+                    windows[index][1] = page
+                else:
+                    index = len(windows)
+                    windows.append([page, page, col_start, col_end])
+                current[key] = index
+            previous = current
+        return windows
+
+    def _write_window(self, buffer, page_start, page_end, col_start, col_end):
+        """Set the display address window and write its part of buffer."""
+        self.write_commands([
+            SSD1306_COLUMNADDR,
+            col_start,                     # Column start address.
+            col_end,                       # Column end address.
+            SSD1306_PAGEADDR,
+            page_start,                    # Page start address.
+            page_end,                      # Page end address.
+        ])
+        if col_start == 0 and col_end == self.width-1:
+            data = buffer[page_start*self.width:(page_end+1)*self.width]
+        else:
+            data = b''.join(buffer[page*self.width+col_start:page*self.width+col_end+1]
+                            for page in range(page_start, page_end+1))
         # Write buffer data.
         if self._spi is not None:
             # Set DC high for data.
             self._gpio.set_high(self._dc)
             # Write buffer.
-            self._spi.write(self._buffer)
+            self._spi.write(list(data))
         else:
-            for i in range(0, len(self._buffer), 16):
+            # One transaction per block, a single one with the RDWR transport.
+            block_size = self._i2c.block_size
+            for i in range(0, len(data), block_size):
                 control = 0x40   # Co = 0, DC = 0
-                self._i2c._i2c_write_i2c_block_data(self.addr, control, self._buffer[i:i+16])
+                self._i2c._i2c_write_i2c_block_data(self.addr, control, list(data[i:i+block_size]))
 
     def image(self, image):
         """Set buffer to value of Python Imaging Library image.  The image should
@@ -181,6 +592,25 @@ class SSD1306Base(object):
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display ({0}x{1}).' \
                 .format(self.width, self.height))
+        with timer(_image_time):
+            if self.width % 8 != 0:
+                self._image_pixels(image)
+            else:
+                # Pack whole 8x8 pixel blocks from the raw image bytes.
+                self._buffer = pack_image(image.tobytes(), self.width, self.height)
+
+    def set_buffer(self, buffer):
+        """Set buffer to a copy of buffer, page-format bytes as written to the
+        display RAM, e.g. drawn with glyphs.GlyphAtlas.text().
+        """
+        if len(buffer) != len(self._buffer):
+            raise ValueError('Buffer must be {0} bytes.'.format(len(self._buffer)))
+        self._buffer[:] = buffer
+
+    def _image_pixels(self, image):
+        """Pixel by pixel fallback of image(), used when the display width is
+        not a multiple of 8 and the raw image rows are padded.
+        """
         # Grab all the pixels from the image, faster than getpixel.
         pix = image.load()
         # Iterate through the memory pages
@@ -200,15 +630,14 @@ class SSD1306Base(object):
 
     def clear(self):
         """Clear contents of image buffer."""
-        self._buffer = [0x00]*(self.width*self._pages)
+        self._buffer = bytearray(self.width*self._pages)
 
     def set_contrast(self, contrast):
         """Sets the contrast of the display.  Contrast should be a value between
         0 and 255."""
         if contrast < 0 or contrast > 255:
             raise ValueError('Contrast must be a value from 0 to 255 (inclusive).')
-        self.write_command(SSD1306_SETCONTRAST)
-        self.write_command(contrast)
+        self.write_commands([SSD1306_SETCONTRAST, contrast])
 
     def dim(self, dim):
         """Adjusts contrast to dim the display if dim is True, otherwise sets the
@@ -0,0 +1,74 @@
+import threading
+
+try:
+    from gpiozero import DigitalInputDevice
+except ImportError:
+    DigitalInputDevice = None
+
+
+class PowerKey():
+    '''
+    Power key on an input pulled low while it is pressed, handled with
+    gpiozero edge callbacks instead of polling.
+
+    when_pressed() is called on press, when_held() once the key has been
+    kept down for hold_time seconds and when_released() on release.  They
+    run in gpiozero's event thread (when_held in a timer thread), so they
+    must not block the caller for long, except when_held.
+
+    device, a gpiozero DigitalInputDevice or a stand-in from backends, is
+    used instead of opening pin.
+    '''
+
+    def __init__(self, pin, hold_time=2, bounce_time=0.01, device=None):
+        self.hold_time = hold_time
+        self.when_pressed = None
+        self.when_held = None
+        self.when_released = None
+        self._hold_timer = None
+        self._released = threading.Event()
+        if device is None:
+            if DigitalInputDevice is None:
+                raise ImportError('gpiozero is required to read the power key.')
+            device = DigitalInputDevice(pin, pull_up=False, bounce_time=bounce_time)
+        self.device = device
+        # The key pulls the pin low: deactivated means pressed
+        self.device.when_deactivated = self._on_press
+        self.device.when_activated = self._on_release
+        if self.device.value == 1:
+            self._released.set()
+
+    @property
+    def is_pressed(self):
+        return self.device.value == 0
+
+    def wait_for_release(self, timeout=None):
+        return self._released.wait(timeout)
+
+    def close(self):
+        self._cancel_hold()
+        self.device.close()
+
+    def _cancel_hold(self):
+        if self._hold_timer is not None:
+            self._hold_timer.cancel()
+            self._hold_timer = None
+
+    def _on_press(self):
+        self._released.clear()
+        self._cancel_hold()
+        self._hold_timer = threading.Timer(self.hold_time, self._on_hold)
+        self._hold_timer.daemon = True
+        self._hold_timer.start()
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def _on_hold(self):
+        if self.is_pressed and self.when_held is not None:
+            self.when_held()
+
+    def _on_release(self):
+        self._cancel_hold()
+        self._released.set()
+        if self.when_released is not None:
+            self.when_released()
@@ -0,0 +1,149 @@
+import time
+import heapq
+import asyncio
+from timing import histogram
+
+
+class Task():
+    '''
+    A duty run by the Scheduler every period seconds, with its timings
+    '''
+
+    def __init__(self, name, period, func, blocking=False):
+        if period <= 0:
+            raise ValueError('period of %s must be above 0: %s' % (name, period))
+        self.name = name
+        self.period = period
+        self.func = func
+        self.blocking = blocking  # run in the executor by run_async()
+        self.runs = 0
+        self.overruns = 0       # runs that took longer than period
+        self.skipped = 0        # periods missed because the scheduler was behind
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.max_late = 0.0     # worst start delay after the deadline
+        self.histogram = histogram('task.%s' % name)
+
+    def stats(self):
+        return {
+            'period': self.period,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'avg_ms': self.total_time / self.runs * 1000 if self.runs else 0.0,
+            'max_ms': self.max_time * 1000,
+            'max_late_ms': self.max_late * 1000,
+        }
+
+    def account(self, deadline, start, end):
+        '''
+        Record a run due at deadline, return the next deadline
+        '''
+        elapsed = end - start
+        self.runs += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram.observe(elapsed)
+        self.max_late = max(self.max_late, start - deadline)
+        if elapsed > self.period:
+            self.overruns += 1
+        # Keep the phase, skipping the periods that are already over.
+        deadline += self.period
+        if deadline < end:
+            missed = int((end - deadline) / self.period) + 1
+            self.skipped += missed
+            deadline += missed * self.period
+        return deadline
+
+
+class Scheduler():
+    '''
+    Cooperative multi-rate scheduler.  Each task runs every period seconds
+    on the monotonic clock, the next deadlines being kept in a heap.  Tasks
+    run one at a time in the calling thread; a task running longer than its
+    period is counted as an overrun, and periods missed meanwhile are
+    skipped rather than run in a burst.
+    '''
+
+    def __init__(self):
+        self.tasks = {}
+        self._heap = []   # (deadline, seq, task)
+        self._seq = 0
+
+    def add(self, name, period, func, delay=0, blocking=False):
+        '''
+        Run func() every period seconds, the first time after delay seconds.
+        Tasks due at the same time run in the order they were added.
+        blocking tasks are run in the executor by run_async()
+        '''
+        task = Task(name, period, func, blocking)
+        self.tasks[name] = task
+        self._push(time.monotonic() + delay, task)
+        return task
+
+    def set_period(self, name, period):
+        '''
+        Change the period of a task, effective after its next run
+        '''
+        if period <= 0:
+            raise ValueError('period of %s must be above 0: %s' % (name, period))
+        self.tasks[name].period = period
+
+    def _push(self, deadline, task):
+        heapq.heappush(self._heap, (deadline, self._seq, task))
+        self._seq += 1
+
+    def run_pending(self):
+        '''
+        Run the tasks that are due, return the seconds until the next one
+        '''
+        while self._heap:
+            deadline, _, task = self._heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self._heap)
+            task.func()
+            self._push(task.account(deadline, now, time.monotonic()), task)
+        return None
+
+    def run(self):
+        '''
+        Run the tasks forever
+        '''
+        while True:
+            wait = self.run_pending()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    async def run_async(self, executor=None):
+        '''
+        Run the tasks forever as one coroutine each, the blocking ones in
+        executor (the loop's default executor if None).  A task raising
+        stops them all; cancel to stop
+        '''
+        loop = asyncio.get_running_loop()
+        runners = [asyncio.ensure_future(self._run_task(loop, executor, deadline, task))
+                   for deadline, _, task in sorted(self._heap)]
+        try:
+            await asyncio.gather(*runners)
+        finally:
+            for runner in runners:
+                runner.cancel()
+            await asyncio.gather(*runners, return_exceptions=True)
+
+    async def _run_task(self, loop, executor, deadline, task):
+        while True:
+            now = time.monotonic()
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+                now = time.monotonic()
+            if task.blocking:
+                await loop.run_in_executor(executor, task.func)
+            else:
+                task.func()
+            deadline = task.account(deadline, now, time.monotonic())
+
+    def stats(self):
+        return {name: task.stats() for name, task in self.tasks.items()}
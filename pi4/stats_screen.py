@@ -0,0 +1,261 @@
+from PIL import Image, ImageDraw
+
+import glyphs
+from oled import Canvas, Gauge
+
+
+class Region():
+    '''
+    Part of a Layout redrawn by draw(canvas, value) when its value changes.
+    draw() must stay inside box, (x0, y0, x1, y1) with x1, y1 excluded
+    '''
+    __slots__ = ('name', 'box', 'draw', 'value')
+
+    def __init__(self, name, box, draw):
+        self.name = name
+        self.box = box
+        self.draw = draw
+        self.value = None
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def _overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class Layout():
+    '''
+    1 bit screen made of a static background, drawn once, and named regions
+    redrawn only when their value changes, on an oled.Canvas in the page
+    format of the display.
+
+    Regions may overlap: when one changes, the background is restored under
+    it and under every region overlapping it, which are all redrawn in the
+    order they were added
+    '''
+
+    def __init__(self, width, height, draw_background=None):
+        self.width = width
+        self.height = height
+        self.background = Canvas(width, height)
+        if draw_background is not None:
+            draw_background(self.background)
+        self.canvas = self.background.copy()
+        self.regions = []
+        self._names = {}
+        self._full = True   # the whole canvas is new
+
+    def add(self, name, box, draw):
+        region = Region(name, box, draw)
+        self._names[name] = region
+        self.regions.append(region)
+        return region
+
+    def invalidate(self):
+        '''
+        Redraw every region on the next update(), after the canvas was
+        drawn over
+        '''
+        self.canvas.paste(self.background, (0, 0, self.width, self.height))
+        self._full = True
+        for region in self.regions:
+            region.value = None
+
+    def update(self, values):
+        '''
+        Redraw the regions whose value in values, {name: value}, changed.
+        Return the boxes of the canvas that changed, the whole canvas the
+        first time
+        '''
+        dirty = set()
+        for name, value in values.items():
+            region = self._names[name]
+            if region.value is None or value != region.value:
+                region.value = value
+                dirty.add(region)
+        if not dirty and not self._full:
+            return []
+        # Add the regions overlapping the dirty ones, until none is left
+        grown = True
+        while grown:
+            grown = False
+            for region in self.regions:
+                if region not in dirty and any(_overlap(region.box, d.box) for d in dirty):
+                    dirty.add(region)
+                    grown = True
+        regions = [region for region in self.regions if region in dirty]
+        for region in regions:
+            self.canvas.paste(self.background, region.box)
+        for region in regions:
+            region.draw(self.canvas, region.value)
+        if self._full:
+            self._full = False
+            return [(0, 0, self.width, self.height)]
+        return [region.box for region in regions]
+
+
+def _pil_gauge(box, levels, draw_level, size, **options):
+    '''
+    Return the oled.Gauge of the pixels in box drawn with PIL by
+    draw_level(draw, level), for levels 0 to levels-1, each level covering
+    the pixels of the ones below.  Only used to build the gauges, options
+    are given to Gauge
+    '''
+    x0, y0, x1, y1 = box
+    width = x1 - x0
+    masks = [[None] * width for y in range(y0, y1)]
+    for level in range(levels):
+        image = Image.new('1', size)
+        draw_level(ImageDraw.Draw(image), level)
+        pixels = image.load()
+        for y, row in enumerate(masks):
+            for x in range(width):
+                if row[x] is None and pixels[x0 + x, y0 + y]:
+                    row[x] = level
+    return Gauge(x0, y0, masks, **options)
+
+
+class StatsScreen(Layout):
+    '''
+    The system status screen of the 128x64 OLED: CPU usage and temperature
+    gauges on the left, RAM and disk bars on the right, IP at the top.
+
+    The static background is drawn once with PIL, the values with the page
+    format primitives of oled.Canvas, the text from the glyph atlas of font
+    and the gauges from sprites cached per state
+    '''
+    IP = (40, 0, 87, 10)           # x, y, width, height
+    RAM_INFO = (40, 17, 87, 10)
+    RAM = (40, 29, 87, 10)
+    DISK_INFO = (40, 41, 87, 10)
+    DISK = (40, 53, 87, 10)
+    CPU_GAUGE = (0, 12, 30, 42)    # pie slice boxes
+    TEMP_GAUGE = (0, 33, 30, 63)
+    GAUGE_CACHE = 32               # sprites kept per gauge
+
+    def __init__(self, font, temp_unit='F', width=128, height=64):
+        self.font = font
+        self.atlas = glyphs.atlas(font.path, font.size)
+        self.temp_unit = temp_unit
+        super().__init__(width, height, self._draw_background)
+        size = (width, height)
+        # Each gauge state is a sprite of whole pages holding the background
+        # under the gauge, built on first use.  The CPU gauge sprite covers
+        # the top of the usage text, redrawn after it.
+        self.cpu_gauge = _pil_gauge((0, 8, 31, 32), 181, lambda draw, level: draw.pieslice(
+            self.CPU_GAUGE, start=180, end=180 + level, fill=1, outline=1), size,
+            base=self.background, cache_size=self.GAUGE_CACHE)
+        # The lower half, under the temperature text, with its outline
+        base = self.background.copy()
+        outline = Image.new('1', size)
+        ImageDraw.Draw(outline).pieslice(self.TEMP_GAUGE, start=0, end=180, fill=0, outline=1)
+        base.blit(Canvas.from_image(outline).sprite((0, 48, 31, 64)), 0, 48)
+        self.temp_gauge = _pil_gauge((0, 48, 31, 64), 181, lambda draw, level: draw.pieslice(
+            self.TEMP_GAUGE, start=180 - level, end=180, fill=1, outline=1), size,
+            base=base, cache_size=self.GAUGE_CACHE)
+        x, y, w, h = self.IP
+        self.add('cpu_gauge', (0, 8, 31, 32), self._draw_cpu_gauge)
+        self.add('cpu_usage', (0, 27, 40, 41), self._draw_text_at(2, 27))
+        self.add('temp', (0, 33, 40, 64), self._draw_temp)
+        self.add('ram_info', (40, 17, width, 31), self._draw_text_at(*self.RAM_INFO[:2]))
+        self.add('ram', self._bar_box(self.RAM), self._draw_bar(self.RAM))
+        self.add('disk_info', (40, 41, width, 55), self._draw_text_at(*self.DISK_INFO[:2]))
+        self.add('disk', self._bar_box(self.DISK), self._draw_bar(self.DISK))
+        self.add('ip', (x, y, x + w + 1, h + 4), self._draw_text_at(x, y, 0))
+
+    @staticmethod
+    def _bar_box(rect):
+        x, y, w, h = rect
+        return (x, y, x + w + 1, y + h + 1)
+
+    def _text(self, canvas, text, x, y, fill=1):
+        self.atlas.text(canvas.buffer, canvas.width, x, y, str(text), fill)
+
+    def _draw_text_at(self, x, y, fill=1):
+        return lambda canvas, text: self._text(canvas, text, x, y, fill)
+
+    def _draw_background(self, canvas):
+        image = Image.new('1', (self.width, self.height))
+        draw = ImageDraw.Draw(image)
+        draw.text((6, 0), text='CPU', font=self.font, fill=1)
+        draw.pieslice(self.CPU_GAUGE, start=180, end=0, fill=0, outline=1)
+        for x, y, w, h in (self.RAM, self.DISK):
+            draw.rectangle((x, y, x + w, y + h), outline=1, fill=0)
+        # IP badge
+        x, y, w, h = self.IP
+        draw.rectangle((x-13, y, x+w, h), outline=1, fill=1)
+        draw.pieslice((x-25, y, x-3, h+10), start=270, end=0, fill=0, outline=0)
+        canvas.paste(Canvas.from_image(image), (0, 0, self.width, self.height))
+
+    def _draw_cpu_gauge(self, canvas, end):
+        self.cpu_gauge.draw(canvas, end - 180)
+
+    def _draw_temp(self, canvas, value):
+        text, start = value
+        if text is None:
+            return
+        # The gauge pages start below the text
+        self._text(canvas, text, 2, 38)
+        self.temp_gauge.draw(canvas, 180 - start)
+
+    def _draw_bar(self, rect):
+        x, y, w, h = rect
+        return lambda canvas, end: canvas.bar((x, y, x + w, y + h), end)
+
+    def values(self, status):
+        '''
+        Return the values of the regions for status, a SystemStatus, as they
+        are shown
+        '''
+        CPU_temp_C = status.cpu_temp # celcius
+        CPU_temp_F = float(CPU_temp_C * 1.8 + 32) # fahrenheit
+        CPU_usage = status.cpu_usage
+
+        if self.temp_unit == 'F':
+            temp = ('{:>4.1f} \'F'.format(CPU_temp_F), _clamp(int(180-180*(CPU_temp_F-32)/1.8*0.01), 0, 180))
+        elif self.temp_unit == 'C':
+            temp = ('{:>4.1f} \'C'.format(CPU_temp_C), _clamp(int(180-180*CPU_temp_C*0.01), 0, 180))
+        else:
+            temp = (None, None)
+
+        ram_total = round(status.ram_total, 1)
+        ram_used = round(status.ram_used, 1)
+        ram_percent = round(status.ram_percent, 1)
+
+        disk_total = status.disk_total
+        disk_used = status.disk_used
+        if disk_total >= 1000:
+            disk_total = round(disk_total/1000, 3)
+            disk_used = round(disk_used/1000, 3)
+            disk_info = f'DISK: {disk_used:>2.2f}/{disk_total:<2.2f} T'
+        elif disk_total >= 100:
+            _dec = 1 if disk_used < 100 else 0
+            disk_info = f'DISK: {disk_used:>3.{_dec}f}/{disk_total:<3.0f} G'
+        else:
+            _dec = 2 if disk_used < 10 else 1
+            disk_info = f'DISK: {disk_used:>2.{_dec}f}/{disk_total:<2.1f} G'
+
+        return {
+            'cpu_gauge': _clamp(int(180+180*CPU_usage*0.01), 180, 360),
+            'cpu_usage': '{:^5.1f} %'.format(CPU_usage),
+            'temp': temp,
+            'ram_info': f'RAM:  {ram_used:^4.1f}/{ram_total:^4.1f} G',
+            'ram': self._bar_end(self.RAM, ram_percent),
+            'disk_info': disk_info,
+            'disk': self._bar_end(self.DISK, status.disk_percent),
+            'ip': status.ip,
+        }
+
+    @staticmethod
+    def _bar_end(rect, percent):
+        x, y, w, h = rect
+        return x + int(w*percent/100.0)
+
+    def render(self, status):
+        '''
+        Redraw what changed for status, return the changed boxes
+        '''
+        return self.update(self.values(status))
@@ -1,7 +1,13 @@
 import os
+import time
+import socket
+import struct
+import select
+import threading
 import subprocess
 import shutil
 import psutil
+from timing import timer
 
 
 def get_cpu_temperature():
@@ -42,6 +48,30 @@ def get_disk_info():
     return(disk)
 
 def getIP():
+    '''
+    Return {interface: IPv4 address} for every network interface but lo,
+    with '' for the interfaces without an address
+    '''
+    IPs = {}
+    NIC_devices = []
+    NIC_devices = os.listdir('/sys/class/net/')
+    addrs = psutil.net_if_addrs()
+
+    for NIC in NIC_devices:
+        if NIC == 'lo':
+            continue
+        IPs[NIC] = ''
+        for addr in addrs.get(NIC, []):
+            if addr.family == socket.AF_INET:
+                IPs[NIC] = addr.address
+                break
+    return IPs
+
+def getIP_ifconfig():
+    '''
+    getIP() through one ifconfig process per interface, kept for comparison
+    by benchmarks/getip.py
+    '''
     IPs = {}
     NIC_devices = []
     NIC_devices = os.listdir('/sys/class/net/')
@@ -71,6 +101,184 @@ def getMAC():
             continue
     return MACs
 
+# rtnetlink multicast groups and message types, see <linux/rtnetlink.h>
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+_NLMSGHDR = struct.Struct('=LHHLL')   # len, type, flags, seq, pid
+
+def preferred_ip(IPs):
+    '''
+    Return the address to show from a getIP() dict: wlan0, else eth0, else
+    the first interface, or 'DISCONNECT'
+    '''
+    if 'wlan0' in IPs and IPs['wlan0'] != None and IPs['wlan0'] != '':
+        return IPs['wlan0']
+    elif 'eth0' in IPs and IPs['eth0'] != None and IPs['eth0'] != '':
+        return IPs['eth0']
+    elif len(IPs.keys()) > 0:
+        interface = list(IPs.keys())[0]
+        if IPs[interface] != None and IPs[interface] != '':
+            return IPs[interface]
+    return 'DISCONNECT'
+
+
+class SystemStatus():
+    '''
+    One set of system metrics, as collected by SystemSnapshot
+    '''
+    __slots__ = (
+        'time',
+        'cpu_temp', 'cpu_usage',
+        'ram_total', 'ram_used', 'ram_percent',
+        'disk_total', 'disk_used', 'disk_percent',
+        'ips', 'ip',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def copy(self):
+        status = SystemStatus()
+        for name in self.__slots__:
+            setattr(status, name, getattr(self, name))
+        return status
+
+
+class IPWatcher():
+    '''
+    Keeps ips (as getIP()) and ip (as preferred_ip()) up to date from the
+    rtnetlink address and link events, read by a background thread from an
+    AF_NETLINK socket.  Readers just use the attributes.
+    '''
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        # Subscribe before the first read so that no change can be missed
+        self._sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        # Written by close() to wake the thread up
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self.ips = {}
+        self.ip = 'DISCONNECT'
+        self.refresh()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ip_watcher', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        os.write(self._wakeup_w, b'\0')
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+        self._sock.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def refresh(self):
+        ips = getIP()
+        self.ips, self.ip = ips, preferred_ip(ips)
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select([self._sock, self._wakeup_r], [], [])
+            if self._wakeup_r in readable:
+                return
+            try:
+                data = self._sock.recv(65536)
+            except OSError:
+                # Receive buffer overrun, events were lost
+                self.refresh()
+                continue
+            offset = 0
+            changed = False
+            while offset + _NLMSGHDR.size <= len(data):
+                length, msg_type, _, _, _ = _NLMSGHDR.unpack_from(data, offset)
+                if msg_type in (RTM_NEWADDR, RTM_DELADDR, RTM_NEWLINK, RTM_DELLINK):
+                    changed = True
+                if length < _NLMSGHDR.size:
+                    break
+                offset += (length + 3) & ~3   # NLMSG_ALIGN
+            if changed:
+                self.refresh()
+
+
+class SystemSnapshot():
+    '''
+    Collects all the system metrics in one call of collect(), each metric
+    being re-read only once its refresh interval (seconds) has passed.  With
+    an IPWatcher the IPs are taken from it instead of being polled
+    '''
+    INTERVALS = {
+        'cpu_temp': 0,      # every call
+        'cpu_usage': 0,
+        'ram': 1,
+        'disk': 30,
+        'ip': 10,
+    }
+
+    def __init__(self, intervals=None, ip_watcher=None):
+        self.ip_watcher = ip_watcher
+        self.intervals = dict(self.INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self._next = {name: 0 for name in self.intervals}
+        self.status = SystemStatus()
+
+    def _due(self, name, now):
+        if now >= self._next[name]:
+            self._next[name] = now + self.intervals[name]
+            return True
+        return False
+
+    def invalidate(self, name=None):
+        '''
+        Re-read metric name (all metrics if None) on the next collect()
+        '''
+        for key in ([name] if name else self._next):
+            self._next[key] = 0
+
+    def collect(self):
+        '''
+        Return a new SystemStatus with the metrics that are due refreshed
+        '''
+        now = time.monotonic()
+        status = self.status.copy()
+        status.time = now
+        if self._due('cpu_temp', now):
+            with timer('status.cpu_temp'):
+                status.cpu_temp = float(get_cpu_temperature())
+        if self._due('cpu_usage', now):
+            with timer('status.cpu_usage'):
+                status.cpu_usage = float(get_cpu_usage())
+        if self._due('ram', now):
+            with timer('status.ram'):
+                ram_info = get_ram_info()
+            status.ram_total = ram_info['total']
+            status.ram_used = ram_info['used']
+            status.ram_percent = ram_info['percent']
+        if self._due('disk', now):
+            with timer('status.disk'):
+                disk_info = get_disk_info()
+            status.disk_total = disk_info['total']
+            status.disk_used = disk_info['used']
+            status.disk_percent = disk_info['percent']
+        if self.ip_watcher is not None:
+            status.ips = self.ip_watcher.ips
+            status.ip = self.ip_watcher.ip
+        elif self._due('ip', now):
+            with timer('status.ip'):
+                status.ips = getIP()
+            status.ip = preferred_ip(status.ips)
+        self.status = status
+        return status
+
 
 if __name__ == '__main__':
     # CPU informatiom
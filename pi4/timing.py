@@ -0,0 +1,107 @@
+'''
+Timers for the hot paths of the daemon, aggregated per stage into fixed
+bucket histograms kept in memory.
+
+    with timer('oled.draw'):
+        ...
+
+A timer costs two perf_counter() calls and a bisect.  Counts updated
+concurrently from several threads may rarely lose an observation.
+'''
+import time
+from bisect import bisect_left
+
+# Upper bounds of the buckets, in seconds, a last one catches the rest
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram():
+    '''
+    Count of the observed durations per bucket, with their sum and max
+    '''
+    __slots__ = ('name', 'buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''
+        Return the q quantile, interpolated in the bucket holding it, at
+        most max
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and total + count >= rank:
+                return min(lower + (bound - lower) * (rank - total) / count, self.max)
+            total += count
+            lower = bound
+        return self.max
+
+
+histograms = {}
+
+def histogram(name):
+    '''
+    Return the histogram of stage name, created on first use
+    '''
+    try:
+        return histograms[name]
+    except KeyError:
+        return histograms.setdefault(name, Histogram(name))
+
+
+class timer():
+    '''
+    Context manager adding the time spent in its block to a histogram,
+    given by name or as the Histogram itself
+    '''
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, name):
+        self.histogram = name if isinstance(name, Histogram) else histogram(name)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def reset():
+    for hist in list(histograms.values()):
+        hist.reset()
+
+def dump():
+    '''
+    Return a table of the histograms, times in milliseconds
+    '''
+    lines = ['%-20s %8s %9s %9s %9s %9s %9s' % ('stage', 'count', 'avg', 'p50', 'p90', 'p99', 'max')]
+    for name in sorted(histograms):
+        hist = histograms[name]
+        avg = hist.sum / hist.count if hist.count else 0.0
+        lines.append('%-20s %8d %9.3f %9.3f %9.3f %9.3f %9.3f' % (
+            name, hist.count, avg * 1000, hist.quantile(0.5) * 1000,
+            hist.quantile(0.9) * 1000, hist.quantile(0.99) * 1000, hist.max * 1000))
+    return '\n'.join(lines)
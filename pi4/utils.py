@@ -1,19 +1,212 @@
 #!/usr/bin/env python3
+import os
 import sys
 import time
-from app_info import __app_name__
-
-def log(msg:str=None,level='DEBUG',end='\n',flush=False,timestamp=True):
-    with open('/opt/%s/log'%__app_name__,'a+') as log_file:
-        if timestamp == True:
-            _time = time.strftime("%y/%m/%d %H:%M:%S", time.localtime())
-            ct = time.time()
-            _msecs = '%03d '%((ct - int(ct)) * 1000)
-            print('%s,%s[%s] %s'%(_time,_msecs,level,msg), end=end, flush=flush, file=log_file)
-            print('%s,%s[%s] %s'%(_time,_msecs,level,msg), end=end, flush=flush, file=sys.stdout)
-        else:
-            print('%s'%msg, end=end, flush=flush, file=log_file)
-            print('%s'%msg, end=end, flush=flush, file=sys.stdout)
+import gzip
+import queue
+import shutil
+import atexit
+import threading
+from app_info import work_dir
+
+# Log levels, level names that are not listed here count as INFO
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {
+    'DEBUG': DEBUG,
+    'INFO': INFO,
+    'WARNING': WARNING,
+    'ERROR': ERROR,
+}
+
+
+class Logger():
+    '''
+    Log writer keeping one file handle open.  Lines are queued by write()
+    and written to the file and stdout by a background thread, in batches
+    with one flush each.  When the bounded queue is full, lines are dropped
+    and counted.
+
+    Once the file grows over max_size bytes, if not 0, it is moved aside and
+    a new one is started; another thread then gzips it to <file>.1.gz,
+    shifting the older archives up to <file>.<backup_count>.gz.
+    '''
+
+    def __init__(self, file, level=DEBUG, max_size=1024*1024, backup_count=5,
+                 queue_size=1000, stdout=True):
+        self.file = file
+        self.level = level
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.stdout = stdout
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._size = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        # Notified by the thread after each batch written
+        self._written = threading.Condition()
+        self._compressor = None
+        self._capture = False   # fd 2 follows the log file
+
+    def enabled(self, level):
+        return LEVELS.get(level, INFO) >= self.level
+
+    def write(self, line):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='log', daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=1):
+        '''
+        Wait until the queued lines are written, at most timeout seconds
+        '''
+        if self._thread is None:
+            return
+        with self._written:
+            self._written.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def close(self):
+        '''
+        Write what is queued, then stop the thread and close the file
+        '''
+        if self._thread is None:
+            return
+        self.flush()
+        try:
+            self._queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        self._thread.join(1)
+        self._thread = None
+
+    def _open(self):
+        try:
+            self._file = open(self.file, 'a')
+            self._size = self._file.tell()
+        except OSError as e:
+            self._file = None
+            print('open log file failed: %s' % e, file=sys.stderr)
+
+    def _rotate(self):
+        if self._compressor is not None and self._compressor.is_alive():
+            # Previous segment not archived yet, rotate on a later write.
+            return
+        self._file.close()
+        self._file = None
+        try:
+            os.replace(self.file, self.file + '.1')
+            self._compressor = threading.Thread(target=self._compress, name='log_gzip', daemon=True)
+            self._compressor.start()
+        except OSError as e:
+            print('rotate log file failed: %s' % e, file=sys.stderr)
+        self._open()
+        if self._capture:
+            self._redirect_stderr()
+
+    def _compress(self):
+        '''
+        Shift the archives one up, dropping the oldest, and gzip <file>.1
+        '''
+        try:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '%s.%d.gz' % (self.file, i)
+                if os.path.exists(src):
+                    os.replace(src, '%s.%d.gz' % (self.file, i + 1))
+            if self.backup_count > 0:
+                with open(self.file + '.1', 'rb') as src, \
+                        gzip.open(self.file + '.1.gz.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(self.file + '.1.gz.tmp', self.file + '.1.gz')
+            os.remove(self.file + '.1')
+        except OSError as e:
+            print('compress log file failed: %s' % e, file=sys.stderr)
+
+    def capture_stderr(self):
+        '''
+        Point file descriptor 2 at the log file, and at the new one after
+        each rotation.  What Python or native code writes there goes to the
+        file at once, so that errors printed right before a crash are kept
+        '''
+        self._capture = True
+        self._redirect_stderr()
+
+    def _redirect_stderr(self):
+        try:
+            fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except OSError as e:
+            print('open log file for stderr failed: %s' % e, file=sys.stderr)
+            return
+        os.dup2(fd, 2)
+        os.close(fd)
+
+    def _run(self):
+        self._open()
+        while True:
+            lines = [self._queue.get()]
+            while lines[-1] is not None:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            count = len(lines)
+            closing = lines[-1] is None
+            if closing:
+                lines.pop()
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append('[log] %d lines dropped, queue full\n' % dropped)
+            text = ''.join(lines)
+            if self._file is not None:
+                try:
+                    self._file.write(text)
+                    self._file.flush()
+                    # Counting what was written to stderr too
+                    self._size = os.fstat(self._file.fileno()).st_size
+                    if self.max_size and self._size > self.max_size:
+                        self._rotate()
+                except OSError as e:
+                    print('write log file failed: %s' % e, file=sys.stderr)
+            if self.stdout:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            for _ in range(count):
+                self._queue.task_done()
+            with self._written:
+                self._written.notify_all()
+            if closing:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+
+# Rotated only by the daemon, see main.py
+logger = Logger('%s/log'%work_dir, max_size=0)
+atexit.register(logger.close)
+
+
+def log(msg:str=None,level='INFO',end='\n',flush=False,timestamp=True):
+    if not logger.enabled(level):
+        return
+    if timestamp == True:
+        ct = time.time()
+        _time = time.strftime("%y/%m/%d %H:%M:%S", time.localtime(ct))
+        _msecs = '%03d '%((ct - int(ct)) * 1000)
+        logger.write('%s,%s[%s] %s%s'%(_time,_msecs,level,msg,end))
+    else:
+        logger.write('%s%s'%(msg,end))
+    if flush:
+        logger.flush()
 
 def run_command(cmd):
     import subprocess
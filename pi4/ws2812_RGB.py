@@ -1,7 +1,22 @@
 import time
+import queue
+import threading
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import chain
 
 from utils import log
-from rpi_ws281x import PixelStrip, Color  # https://github.com/jgarff/rpi_ws281x
+from timing import timer, histogram
+# Only needed to drive a real strip, frames are built without it
+try:
+    from rpi_ws281x import PixelStrip, Color  # https://github.com/jgarff/rpi_ws281x
+except ImportError:
+    PixelStrip = None
+
+    def Color(red, green, blue, white=0):
+        """Same packing as rpi_ws281x.Color."""
+        return (white << 24) | (red << 16) | (green << 8) | blue
 
 
 RGB_styles = [
@@ -35,6 +50,230 @@ colorful_leds = [
 ]
 
 
+# str or hex, eg: 'ee55ee', '#ee55ee', '#EE55EE'
+def hex_to_rgb(hex):
+    try:
+        hex = hex.strip().replace('#', '')
+        return tuple(int(hex[i:i+2], 16) for i in (0, 2, 4))
+    except Exception as e:
+        log('color parameter error: \n%s' % e, level='ERROR')
+
+
+def _scale(color, percent):
+    r, g, b = [int(x * percent * 0.01) for x in color]
+    return Color(r, g, b)
+
+
+class Animation():
+    """A style compiled into a table of frames, replayed by WS2812.play().
+
+    frames[i] holds the packed 24 bit color of every LED, durations[i] how
+    long (in seconds) frame i stays on, and changes[i] the (index, color)
+    pairs that turn frame i-1 into frame i (the last frame for i = 0).
+    """
+
+    def __init__(self, frames, durations):
+        self.frames = [array('I', frame) for frame in frames]
+        self.durations = array('d', durations)
+        # Start time of each frame within a cycle, and the cycle length.
+        self.starts = array('d')
+        t = 0.0
+        for duration in self.durations:
+            self.starts.append(t)
+            t += duration
+        self.cycle_time = t
+        self.changes = []
+        for i, frame in enumerate(self.frames):
+            previous = self.frames[i-1]
+            self.changes.append(tuple(
+                (index, color) for index, color in enumerate(frame)
+                if color != previous[index]))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame_at(self, t):
+        """Return (cycle, index) of the frame shown t seconds after start."""
+        if self.cycle_time <= 0:
+            return 0, 0
+        cycle, t = divmod(t, self.cycle_time)
+        return int(cycle), bisect_right(self.starts, t) - 1
+
+    def end_of(self, cycle, index):
+        """Return the time after start at which frame (cycle, index) ends."""
+        return cycle * self.cycle_time + self.starts[index] + self.durations[index]
+
+
+class FrameScheduler():
+    """Runs an Animation on the monotonic clock at no more than fps frames
+    per second.  When behind, late frames are dropped so the animation keeps
+    its real time speed, instead of slowing down as sleep() loops do.
+    """
+
+    def __init__(self, fps=60):
+        if fps <= 0:
+            raise ValueError('fps must be above 0: {}'.format(fps))
+        self.fps = fps
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0         # frames shown
+        self.dropped = 0        # frames skipped, late or above fps
+        self.jitter_max = 0.0   # worst wake up delay, in seconds
+        self._jitter_sum = 0.0
+        self._wakes = 0
+        self._stats_start = time.monotonic()
+
+    def stats(self):
+        """Return achieved fps, dropped frames and wake up jitter (ms)."""
+        elapsed = time.monotonic() - self._stats_start
+        return {
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'jitter_avg': self._jitter_sum / self._wakes * 1000 if self._wakes else 0.0,
+            'jitter_max': self.jitter_max * 1000,
+        }
+
+    def run(self, animation, show, wait=None):
+        """Play animation until wait() returns True, forever if wait is None.
+
+        show(index, incremental) must output frame index of the animation;
+        incremental is True when the previous frame shown is the one right
+        before it, so that only animation.changes[index] need to be written.
+        wait(timeout) sleeps up to timeout seconds.
+        """
+        if wait is None:
+            wait = lambda timeout: time.sleep(timeout)
+        count = len(animation)
+        frame_time = 1 / self.fps
+        start = wake = time.monotonic()
+        last = None
+        while True:
+            now = time.monotonic()
+            late = now - wake
+            if late > 0:
+                self._jitter_sum += late
+                self.jitter_max = max(self.jitter_max, late)
+            self._wakes += 1
+
+            cycle, index = animation.frame_at(now - start)
+            if (cycle, index) != last:
+                position = cycle * count + index
+                skipped = position - last_position - 1 if last is not None else -1
+                if skipped > 0:
+                    self.dropped += skipped
+                show(index, skipped == 0)
+                self.frames += 1
+                last, last_position = (cycle, index), position
+
+            # Wake up for the next frame, but not more often than fps.
+            wake = max(start + animation.end_of(cycle, index), wake + frame_time)
+            if wait(max(0.0, wake - time.monotonic())):
+                return
+
+
+# Frame builders, one per style in RGB_styles.  Each yields (colors, delay)
+# for every frame of one animation cycle, colors being mutated in place.
+
+def _breath(color, speed, led_count, order):
+    delay = 0.001 * (101 - speed)
+    state = [0] * led_count
+    for i in chain(range(2, 101), range(100, 1, -1)):
+        c = _scale(color, i)
+        for index in order:
+            state[index] = c
+        yield state, delay
+
+def _static(color, speed, led_count, order):
+    # No breath
+    state = [0] * led_count
+    for index in order:
+        state[index] = Color(*color)
+    yield state, 2
+
+def _leap(color, speed, led_count, order):
+    delay = 0.001 * (101 - speed)
+    for i in range(led_count):
+        state = [0] * led_count
+        state[i] = Color(*color)
+        yield state, delay
+
+def _flow(color, speed, led_count, order):
+    speed = 101 - speed
+    state = [0] * led_count
+    for index in order:
+        state[index] = Color(*color)
+        yield state, 0.001 * speed
+    yield [0] * led_count, 0.005 * speed
+
+def _raise_up(color, speed, led_count, order):
+    speed = 101 - speed
+    state = [0] * led_count
+    for first, last in ((0, 4), (4, 8), (8, len(order))):
+        for i in range(2, 101):
+            c = _scale(color, i)
+            for index in range(first, last):
+                state[order[index]] = c
+            delay = 0.0002 * speed
+            if last == len(order) and i == 100:
+                delay += 10 * 0.0005 * speed
+            yield state, delay
+    # Turn off
+    for index in order:
+        state[order[index]] = 0
+        yield state, 0.001 * speed
+
+def _colorful(color, speed, led_count, order):
+    delay = 0.001 * (101 - speed)
+    _color = [hex_to_rgb(colorful_leds[i]) for i in range(led_count)]
+    state = [0] * led_count
+    for i in chain(range(2, 101), range(100, 1, -1)):
+        for index in order:
+            state[index] = _scale(_color[index], i)
+        yield state, delay
+
+def _colorful_static(color, speed, led_count, order):
+    # No breath
+    state = [0] * led_count
+    for index in order:
+        state[index] = Color(*hex_to_rgb(colorful_leds[index]))
+    yield state, 2
+
+def _colorful_leap(color, speed, led_count, order):
+    delay = 0.001 * (101 - speed)
+    for i in range(led_count):
+        state = [0] * led_count
+        state[i] = Color(*hex_to_rgb(colorful_leds[i]))
+        yield state, delay
+
+_builders = {
+    'breath': _breath,
+    'static': _static,
+    'leap': _leap,
+    'flow': _flow,
+    'raise_up': _raise_up,
+    'colorful': _colorful,
+    'colorful_static': _colorful_static,
+    'colorful_leap': _colorful_leap,
+}
+
+
+@lru_cache(maxsize=8)
+def compile_animation(style, color, speed, led_count, order):
+    """Build the Animation of style for an (r, g, b) color and a speed in
+    0 ~ 100.  order is the tuple of LED indexes, as WS2812.lights_order.
+    Raises KeyError for an unknown style.
+    """
+    builder = _builders[style]
+    frames = []
+    durations = []
+    for state, delay in builder(color, speed, led_count, order):
+        frames.append(list(state))
+        durations.append(delay)
+    return Animation(frames, durations)
+
+
 class WS2812():
 
     lights_order = [i for i in range(16)]
@@ -47,6 +286,8 @@ class WS2812():
         LED_FREQ_HZ=1000000,
         LED_DMA=10,
         LED_INVERT=False,
+        fps=60,
+        strip_class=None,
     ):
         self.led_count = LED_COUNT
         self.led_pin = LED_PIN
@@ -55,10 +296,15 @@ class WS2812():
         self.led_dma = LED_DMA
         self.led_invert = LED_INVERT
         self.strip = None
+        # PixelStrip or a stand-in taking the same arguments, see backends
+        self.strip_class = strip_class or PixelStrip
+        if self.strip_class is None:
+            raise ImportError('rpi_ws281x is required to drive the strip.')
+        self.scheduler = FrameScheduler(fps)
         self.init()
 
     def init(self):
-        self.strip = PixelStrip(self.led_count, self.led_pin, self.led_freq_hz,
+        self.strip = self.strip_class(self.led_count, self.led_pin, self.led_freq_hz,
                                 self.led_dma, self.led_invert, self.led_brightness)
         time.sleep(0.01)
         self.strip.begin()
@@ -67,13 +313,13 @@ class WS2812():
         if self.strip is None:
             self.init()
 
-    # str or hex, eg: 'ee55ee', '#ee55ee', '#EE55EE'
     def hex_to_rgb(self, hex):
-        try:
-            hex = hex.strip().replace('#', '')
-            return tuple(int(hex[i:i+2], 16) for i in (0, 2, 4))
-        except Exception as e:
-            log('color parameter error: \n%s' % e)
+        return hex_to_rgb(hex)
+
+    def set_brightness(self, LED_BRIGHTNESS):
+        self.led_brightness = int(LED_BRIGHTNESS * 225 / 100)
+        self.reinit()
+        self.strip.setBrightness(self.led_brightness)
 
     def clear(self, color: str = '#000000'):
         r, g, b = self.hex_to_rgb(color)
@@ -83,144 +329,150 @@ class WS2812():
             self.strip.setPixelColor(i, Color(r, g, b))
         self.strip.show()
 
+    def compile(self, style: str, color: list = [255, 255, 255], speed=50):
+        return compile_animation(style, tuple(color), speed, self.led_count,
+                                 tuple(self.lights_order))
+
     def display(self, style: str, color: str = '#ee55ee', speed=50):
         color = list(self.hex_to_rgb(color))
         self.clear()
 
         try:
-            fuc = getattr(self, style)
-            fuc(color, speed)
+            self.play(self.compile(style, color, speed))
         except KeyError as e:
-            log(f'LED strip parameter error: {e}')
+            log(f'LED strip parameter error: {e}', level='ERROR')
         except Exception as e:
-            log(f'LED display error: {e}')
+            log(f'LED display error: {e}', level='ERROR')
 
+    def write_frame(self, frame):
+        """Load every LED color of frame into the strip, without showing it."""
+        for index, color in enumerate(frame):
+            self.strip.setPixelColor(index, color)
 
-    def breath(self, color: list = [255, 255, 255], speed=50):
-        speed = 101 - speed
-        while True:
-            self.reinit()
-            for i in range(2, 101):
-                r, g, b = [int(x * i * 0.01) for x in color]
-                for index in self.lights_order:
-                    self.strip.setPixelColor(index, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
-            for i in range(100, 1, -1):
-                r, g, b = [int(x * i * 0.01) for x in color]
-                for index in self.lights_order:
-                    self.strip.setPixelColor(index, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
+    def play(self, animation: Animation, wait=None):
+        """Play animation through the frame scheduler until wait() returns
+        True, see FrameScheduler.run().  Only the LEDs that differ from the
+        previous frame are written before each show()."""
+        self.reinit()
+        frame_time = histogram('ws2812.frame')
 
-    def static(self, color: list = [255, 255, 255], speed=50):
-        while True:
-            self.reinit()
-            # No breath
-            r, g, b =  color
-            for index in self.lights_order:
-                self.strip.setPixelColor(index, Color(r,g,b))
-            self.strip.show()
-            time.sleep(2)
-
-    def leap(self, color: list = [255, 255, 255], speed=50):
-        speed = 101 - speed
-        r, g, b = color
-        while True:
-            self.reinit()
-            for i in range(self.led_count):
-                for index in self.lights_order:
-                    self.strip.setPixelColor(index, Color(0, 0, 0))
-                self.strip.setPixelColor(i, Color(r, g, b))
+        def show(index, incremental):
+            with timer(frame_time):
+                if incremental:
+                    for led, color in animation.changes[index]:
+                        self.strip.setPixelColor(led, color)
+                else:
+                    self.write_frame(animation.frames[index])
                 self.strip.show()
-                time.sleep(0.001 * speed)
 
-    def flow(self, color: list = [255, 255, 255], speed=50):
-        speed = 101 - speed
-        r, g, b = color
-        while True:
-            self.reinit()
-            for index in self.lights_order:
-                self.strip.setPixelColor(index, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
-            for j in range(self.led_count):
-                self.strip.setPixelColor(j, Color(0, 0, 0))
-            self.strip.show()
-            time.sleep(0.005 * speed)
-
-    def raise_up(self, color: list = [255, 255, 255], speed=50):
-        speed = 101 - speed
-        r, g, b = color
-        while True:
-            self.reinit()
-            for i in range(2, 101):
-                r, g, b = [int(x * i * 0.01) for x in color]
-                for index in range(0, 4, 1):
-                    self.strip.setPixelColor(self.lights_order[index], Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.0002 * speed)
-            for i in range(2, 101):
-                r, g, b = [int(x * i * 0.01) for x in color]
-                for index in range(4, 8, 1):
-                    self.strip.setPixelColor(self.lights_order[index], Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.0002 * speed)
-            for i in range(2, 101):
-                r, g, b = [int(x * i * 0.01) for x in color]
-                for index in range(8, 16, 1):
-                    self.strip.setPixelColor(self.lights_order[index], Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.0002 * speed)
-            # Turn off
-            time.sleep(10 * 0.0005 * speed)
-            for index in self.lights_order:
-                self.strip.setPixelColor(self.lights_order[index], Color(0, 0, 0))
-                self.strip.show()
-                time.sleep(0.001 * speed)
+        self.scheduler.run(animation, show, wait)
 
-    def colorful(self, color: list = None, speed=50):
-        speed = 101 - speed
-        _color = list(
-            self.hex_to_rgb(colorful_leds[i]) for i in range(self.led_count))
-        while True:
-            self.reinit()
-            for i in range(2, 101):
-                for index in self.lights_order:
-                    r, g, b = [int(x * i * 0.01) for x in _color[index]]
-                    self.strip.setPixelColor(index, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
-            for i in range(100, 1, -1):
-                for index in self.lights_order:
-                    r, g, b = [int(x * i * 0.01) for x in _color[index]]
-                    self.strip.setPixelColor(index, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
 
-    def colorful_static(self, color: list = None, speed=50):
-        _color = list(
-            self.hex_to_rgb(colorful_leds[i]) for i in range(self.led_count))
-        while True:
-            self.reinit()
-            # No breath
-            for index in self.lights_order:
-                r, g, b =  _color[index]
-                self.strip.setPixelColor(index, Color(r, g, b))
-            self.strip.show()
-            time.sleep(2)
-
-    def colorful_leap(self, color: list = None, speed=50):
-        speed = 101 - speed
+class RGBController():
+    """Owns the thread animating a WS2812 strip.
+
+    Style, color, speed and brightness changes, stop() and resume() are
+    passed to the thread through a queue and take effect within one frame,
+    without restarting the strip.
+    """
+
+    def __init__(self, strip: WS2812, style='breath', color='ee55ee', speed=50):
+        self.strip = strip
+        self.style = style
+        self.color = color
+        self.speed = speed
+        self.playing = False
+        self._queue = queue.Queue()
+        self._pending = []
+        self._thread = None
+
+    def start(self, playing=True):
+        """Start the animation thread, with the strip off if not playing."""
+        if self._thread is not None:
+            return
+        self.playing = playing
+        self._thread = threading.Thread(target=self._run, name='rgb', daemon=True)
+        self._thread.start()
+
+    def set_style(self, style):
+        self._queue.put(('style', style))
+
+    def set_color(self, color):
+        self._queue.put(('color', color))
+
+    def set_speed(self, speed):
+        self._queue.put(('speed', speed))
+
+    def set_brightness(self, brightness):
+        """brightness in the unit of WS2812's LED_BRIGHTNESS."""
+        self._queue.put(('brightness', brightness))
+
+    def stop(self):
+        """Stop the animation and turn the strip off."""
+        self._queue.put(('playing', False))
+
+    def resume(self):
+        self._queue.put(('playing', True))
+
+    def close(self, timeout=1):
+        """Stop the thread and turn the strip off."""
+        if self._thread is None:
+            return
+        self._queue.put(('close', None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _wait(self, timeout):
+        # FrameScheduler wait hook, stops playing as soon as a command comes.
+        try:
+            self._pending.append(self._queue.get(timeout=timeout))
+            return True
+        except queue.Empty:
+            return False
+
+    def _apply(self, command):
+        """Apply a queued command, return False when the thread must end."""
+        name, value = command
+        if name == 'close':
+            return False
+        elif name == 'brightness':
+            self.strip.set_brightness(value)
+        else:
+            setattr(self, name, value)
+        return True
+
+    def _run(self):
         while True:
-            self.reinit()
-            for i in range(self.led_count):
-                r, g, b = self.hex_to_rgb(colorful_leds[i])
-                for index in self.lights_order:
-                    self.strip.setPixelColor(index, Color(0, 0, 0))
-                self.strip.setPixelColor(i, Color(r, g, b))
-                self.strip.show()
-                time.sleep(0.001 * speed)
+            if self.playing:
+                try:
+                    log('rgb_show: %s' % self.style, level='DEBUG')
+                    animation = self.strip.compile(
+                        self.style, self.strip.hex_to_rgb(self.color), self.speed)
+                    self.strip.play(animation, self._wait)
+                except KeyError as e:
+                    log(f'LED strip parameter error: {e}', level='ERROR')
+                    self.playing = False
+                except Exception as e:
+                    log(f'LED display error: {e}', level='ERROR')
+                    self.playing = False
+                if not self.playing:
+                    self.strip.clear()
+            else:
+                self._pending.append(self._queue.get())
+            # Apply everything queued before playing again.
+            while True:
+                try:
+                    self._pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            was_playing = self.playing
+            pending, self._pending = self._pending, []
+            for command in pending:
+                if not self._apply(command):
+                    self.strip.clear()
+                    return
+            if was_playing and not self.playing:
+                self.strip.clear()
 
 if __name__ == "__main__":
     speed = 80
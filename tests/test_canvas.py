@@ -0,0 +1,143 @@
+'''
+The page format drawing of oled.Canvas and oled.Gauge against PIL
+'''
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from oled import Canvas, Gauge, pack_image
+
+SIZES = [(128, 64), (40, 24)]
+
+
+def random_image(rng, size):
+    width, height = size
+    return Image.frombytes('1', size, bytes(rng.getrandbits(8) for _ in range(width * height // 8)))
+
+
+def packed(image):
+    return pack_image(image.tobytes(), *image.size)
+
+
+def random_box(rng, size, margin=10):
+    width, height = size
+    x0 = rng.randint(-margin, width + margin)
+    y0 = rng.randint(-margin, height + margin)
+    return x0, y0, x0 + rng.randint(0, width), y0 + rng.randint(0, height)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_fill_rect(size):
+    rng = random.Random(1)
+    image = random_image(rng, size)
+    canvas = Canvas.from_image(image)
+    draw = ImageDraw.Draw(image)
+    for _ in range(300):
+        box = random_box(rng, size)
+        fill = rng.randint(0, 1)
+        canvas.fill_rect(box, fill)
+        draw.rectangle(box, fill=fill)
+        assert canvas.buffer == packed(image), box
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_rect_and_bar(size):
+    rng = random.Random(2)
+    image = random_image(rng, size)
+    canvas = Canvas.from_image(image)
+    draw = ImageDraw.Draw(image)
+    for _ in range(300):
+        x0, y0, x1, y1 = box = random_box(rng, size)
+        # PIL draws boxes without height, or without outline and fill,
+        # its own way; the screen has none
+        if y1 == y0:
+            continue
+        if rng.random() < 0.5:
+            outline, fill = rng.choice([(1, None), (0, None), (None, 1), (1, 0), (0, 1)])
+            canvas.rect(box, outline=outline, fill=fill)
+            draw.rectangle(box, outline=outline, fill=fill)
+        else:
+            end = rng.randint(x0, x1)
+            canvas.bar(box, end)
+            draw.rectangle(box, outline=1, fill=0)
+            draw.rectangle((x0, y0, end, y1), fill=1)
+        assert canvas.buffer == packed(image), box
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_paste(size):
+    rng = random.Random(3)
+    image = random_image(rng, size)
+    source = random_image(rng, size)
+    canvas = Canvas.from_image(image)
+    source_canvas = Canvas.from_image(source)
+    for _ in range(300):
+        box = random_box(rng, size)
+        canvas.paste(source_canvas, box)
+        image.paste(source.crop(box), box)
+        assert canvas.buffer == packed(image), box
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('masked', [False, True])
+def test_blit(size, masked):
+    width, height = size
+    rng = random.Random(4)
+    image = random_image(rng, size)
+    source = random_image(rng, size)
+    mask = random_image(rng, size)
+    canvas = Canvas.from_image(image)
+    source_canvas = Canvas.from_image(source)
+    mask_canvas = Canvas.from_image(mask)
+    for _ in range(300):
+        x0 = rng.randint(0, width - 1)
+        y0 = rng.randint(0, height - 1)
+        x1 = rng.randint(x0 + 1, width)
+        y1 = rng.randint(y0 + 1, height)
+        sprite = source_canvas.sprite((x0, y0, x1, y1), mask_canvas if masked else None)
+        # A page aligned spot half of the time, the unmasked fast path
+        x = rng.randint(-x1 + x0, width)
+        y = rng.randint(-height // 2, height)
+        if rng.random() < 0.5:
+            y = y // 8 * 8
+        canvas.blit(sprite, x, y)
+        # The sprite spans the whole pages under its box
+        crop = (x0, y0 // 8 * 8, x1, (y1 + 7) // 8 * 8)
+        image.paste(source.crop(crop), (x, y), mask.crop(crop) if masked else None)
+        assert canvas.buffer == packed(image), ((x0, y0, x1, y1), x, y)
+
+
+def random_levels(rng, width, height, count):
+    return [[rng.choice([None] + list(range(count))) for x in range(width)] for y in range(height)]
+
+
+@pytest.mark.parametrize('with_base', [False, True])
+def test_gauge(with_base):
+    rng = random.Random(5)
+    size = (40, 24)
+    x0, y0, count = 5, 3, 20
+    levels = random_levels(rng, 21, 17, count)
+    base = random_image(rng, size)
+    gauge = Gauge(x0, y0, levels, base=Canvas.from_image(base) if with_base else None)
+    cached = Gauge(x0, y0, levels, base=Canvas.from_image(base) if with_base else None,
+                   cache_size=4)
+    image = random_image(rng, size)
+    canvas = Canvas.from_image(image)
+    pixels = image.load()
+    for _ in range(100):
+        level = rng.randrange(count)
+        gauge.draw(canvas, level)
+        if with_base:
+            # The whole pages under the shape are copied from the base
+            box = (x0, 0, x0 + gauge.width, gauge.pages * 8)
+            image.paste(base.crop(box), box)
+        for y, row in enumerate(levels):
+            for x, lowest in enumerate(row):
+                if lowest is not None and lowest <= level:
+                    pixels[x0 + x, y0 + y] = 1
+        assert canvas.buffer == packed(image), level
+        sprite, cached_sprite = gauge.sprite(level), cached.sprite(level)
+        assert (cached_sprite.data, cached_sprite.mask) == (sprite.data, sprite.mask)
+        assert cached.sprite(level) is cached_sprite
+        assert len(cached._cache) <= 4
@@ -0,0 +1,52 @@
+'''
+GlyphAtlas.text() against ImageDraw.text()
+'''
+import os
+import random
+import shutil
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from glyphs import CHARSET, GlyphAtlas
+from oled import pack_image
+
+FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pi4', 'Minecraftia-Regular.ttf')
+
+
+@pytest.fixture
+def font_path(tmp_path):
+    # The atlas is cached next to the font
+    path = str(tmp_path / 'Minecraftia-Regular.ttf')
+    shutil.copy(FONT, path)
+    return path
+
+
+@pytest.mark.parametrize('fill', [1, 0])
+def test_text_matches_pil(font_path, fill):
+    width, height = 128, 64
+    font = ImageFont.truetype(font_path, 8)
+    atlas = GlyphAtlas(font_path, 8)
+    rng = random.Random(fill)
+    for _ in range(300):
+        text = ''.join(rng.choice(CHARSET) for _ in range(rng.randint(1, 20)))
+        x, y = rng.randint(-10, width), rng.randint(-10, height)
+        image = Image.new('1', (width, height), 1 - fill)
+        ImageDraw.Draw(image).text((x, y), text, font=font, fill=fill)
+        buffer = bytearray([0xFF if not fill else 0] * (width * height // 8))
+        atlas.text(buffer, width, x, y, text, fill)
+        assert buffer == pack_image(image.tobytes(), width, height), (text, x, y)
+
+
+def test_cached_atlas(font_path):
+    GlyphAtlas(font_path, 8)
+    assert os.path.exists(font_path + '.8.atlas')
+    atlas = GlyphAtlas(font_path, 8)
+    assert atlas._font is None   # Loaded, not rasterized
+
+
+def test_refuses_unmatched_layout(font_path):
+    # At 12 PIL places some glyphs a column off their summed advances
+    with pytest.raises(ValueError):
+        GlyphAtlas(font_path, 12)
+    assert not os.path.exists(font_path + '.12.atlas')
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from backends import SimBus, VirtualSSD1306Bus
+from i2c import I2C
+from oled import SSD1306_128_64, SSD1306_128_32, SSD1306_96_16, pack_image
+
+
+def make_oled(cls):
+    return cls(i2c=I2C(smbus=SimBus()))
+
+
+def random_image(rng, width, height):
+    image = Image.new('1', (width, height))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randrange(20), y + rng.randrange(12)), fill=rng.randint(0, 1))
+    draw.text((rng.randrange(width), rng.randrange(height)), 'pi4 %d' % rng.randrange(100), fill=1)
+    return image
+
+
+@pytest.mark.parametrize('cls', [SSD1306_128_64, SSD1306_128_32, SSD1306_96_16])
+def test_pack_image_matches_pixel_path(cls):
+    oled = make_oled(cls)
+    rng = random.Random(cls.__name__)
+    images = [Image.new('1', (oled.width, oled.height), fill) for fill in (0, 1)]
+    images += [random_image(rng, oled.width, oled.height) for _ in range(50)]
+    for image in images:
+        oled.image(image)
+        packed = bytes(oled._buffer)
+        oled._image_pixels(image)
+        assert packed == bytes(oled._buffer)
+
+
+def test_pack_image_single_pixels():
+    # Each pixel lands on its own bit, LSB on top of the page
+    for x, y in [(0, 0), (7, 0), (8, 7), (127, 63), (64, 33)]:
+        image = Image.new('1', (128, 64))
+        image.putpixel((x, y), 1)
+        buffer = pack_image(image.tobytes(), 128, 64)
+        expected = bytearray(128 * 8)
+        expected[(y // 8) * 128 + x] = 1 << (y % 8)
+        assert buffer == expected
+
+
+class Bus(VirtualSSD1306Bus):
+    def flush(self):
+        pass
+
+
+@pytest.mark.parametrize('transport', [I2C.SMBUS, I2C.RDWR])
+def test_display_sends_changed_windows(transport):
+    bus = Bus()
+    oled = SSD1306_128_64(i2c=I2C(transport=transport, smbus=bus))
+    oled.begin()
+    rng = random.Random(transport)
+    buffer = bytearray(rng.getrandbits(8) for _ in range(1024))
+    for frame in range(200):
+        # A few changed runs, as a redrawn value
+        for _ in range(rng.randint(0, 4)):
+            start = rng.randrange(1024)
+            for i in range(start, min(1024, start + rng.randint(1, 40))):
+                buffer[i] = rng.getrandbits(8)
+        oled.set_buffer(buffer)
+        bus.recorder.reset()
+        oled.display()
+        assert bytes(bus.ram) == bytes(buffer)
+    # Nothing changed, nothing sent
+    bus.recorder.reset()
+    oled.display()
+    assert bus.recorder.bytes == 0
+
+
+def test_dirty_windows_coalesce():
+    oled = make_oled(SSD1306_128_64)
+    shadow = bytes(1024)
+    buffer = bytearray(shadow)
+    # Two close runs on pages 2 and 3, one far on page 2
+    for page in (2, 3):
+        buffer[page*128 + 10] = buffer[page*128 + 14] = 0xFF
+    buffer[2*128 + 100] = 0x01
+    assert oled._dirty_windows(bytes(buffer), shadow) == [[2, 3, 10, 14], [2, 2, 100, 100]]
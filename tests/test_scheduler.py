@@ -0,0 +1,12 @@
+import pytest
+
+from scheduler import Scheduler
+
+
+def test_period_must_be_positive():
+    scheduler = Scheduler()
+    with pytest.raises(ValueError):
+        scheduler.add('zero', 0, lambda: None)
+    scheduler.add('task', 1, lambda: None)
+    with pytest.raises(ValueError):
+        scheduler.set_period('task', -1)
@@ -0,0 +1,127 @@
+'''
+The stats screen against the drawing of the screen before it was split in
+regions, as it was in main.py
+'''
+import os
+import random
+import shutil
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from oled import pack_image
+from stats_screen import StatsScreen
+from system_status import SystemStatus
+
+FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pi4', 'Minecraftia-Regular.ttf')
+
+
+@pytest.fixture(scope='module')
+def font(tmp_path_factory):
+    # The glyph atlas is cached next to the font
+    path = str(tmp_path_factory.mktemp('font') / 'Minecraftia-Regular.ttf')
+    shutil.copy(FONT, path)
+    return ImageFont.truetype(path, 8)
+
+
+def reference(status, temp_unit, font):
+    width, height = 128, 64
+    image = Image.new('1', (width, height))
+    draw = ImageDraw.Draw(image)
+
+    def draw_text(text, x, y, fill=1):
+        draw.text((x, y), text=str(text), font=font, fill=fill)
+
+    CPU_temp_C = status.cpu_temp
+    CPU_temp_F = float(CPU_temp_C * 1.8 + 32)
+    CPU_usage = status.cpu_usage
+    ram_total = round(status.ram_total, 1)
+    ram_used = round(status.ram_used, 1)
+    ram_percent = round(status.ram_percent, 1)
+    disk_total = status.disk_total
+    disk_used = status.disk_used
+    disk_unit = 'G1'
+    if disk_total >= 1000:
+        disk_unit = 'T'
+        disk_total = round(disk_total/1000, 3)
+        disk_used = round(disk_used/1000, 3)
+    elif disk_total >= 100:
+        disk_unit = 'G2'
+
+    draw_text('CPU', 6, 0)
+    draw.pieslice((0, 12, 30, 42), start=180, end=0, fill=0, outline=1)
+    draw.pieslice((0, 12, 30, 42), start=180, end=int(180+180*CPU_usage*0.01), fill=1, outline=1)
+    draw_text('{:^5.1f} %'.format(CPU_usage), 2, 27)
+    if temp_unit == 'F':
+        draw_text('{:>4.1f} \'F'.format(CPU_temp_F), 2, 38)
+        draw.pieslice((0, 33, 30, 63), start=0, end=180, fill=0, outline=1)
+        pcent = (CPU_temp_F-32)/1.8
+        draw.pieslice((0, 33, 30, 63), start=int(180-180*pcent*0.01), end=180, fill=1, outline=1)
+    elif temp_unit == 'C':
+        draw_text('{:>4.1f} \'C'.format(CPU_temp_C), 2, 38)
+        draw.pieslice((0, 33, 30, 63), start=0, end=180, fill=0, outline=1)
+        draw.pieslice((0, 33, 30, 63), start=int(180-180*CPU_temp_C*0.01), end=180, fill=1, outline=1)
+    draw_text(f'RAM:  {ram_used:^4.1f}/{ram_total:^4.1f} G', 40, 17)
+    draw.rectangle((40, 29, 127, 39), outline=1, fill=0)
+    draw.rectangle((40, 29, 40 + int(87*ram_percent/100.0), 39), outline=1, fill=1)
+    if disk_unit == 'G1':
+        _dec = 2 if disk_used < 10 else 1
+        draw_text(f'DISK: {disk_used:>2.{_dec}f}/{disk_total:<2.1f} G', 40, 41)
+    elif disk_unit == 'G2':
+        _dec = 1 if disk_used < 100 else 0
+        draw_text(f'DISK: {disk_used:>3.{_dec}f}/{disk_total:<3.0f} G', 40, 41)
+    else:
+        draw_text(f'DISK: {disk_used:>2.2f}/{disk_total:<2.2f} T', 40, 41)
+    draw.rectangle((40, 53, 127, 63), outline=1, fill=0)
+    draw.rectangle((40, 53, 40 + int(87*status.disk_percent/100.0), 63), outline=1, fill=1)
+    draw.rectangle((27, 0, 127, 10), outline=1, fill=1)
+    draw.pieslice((15, 0, 37, 20), start=270, end=0, fill=0, outline=0)
+    draw_text(status.ip, 40, 0, 0)
+    return image
+
+
+def random_status(rng, previous=None):
+    status = SystemStatus() if previous is None else previous.copy()
+    fields = ['cpu_temp', 'cpu_usage', 'ram', 'disk', 'ip']
+    for field in fields if previous is None else rng.sample(fields, rng.randint(0, 2)):
+        if field == 'cpu_temp':
+            # The gauge covers 0 to 100 C
+            status.cpu_temp = rng.choice([rng.uniform(20, 90), rng.uniform(0, 100), 0.0, 100.0])
+        elif field == 'cpu_usage':
+            status.cpu_usage = rng.choice([rng.uniform(0, 100), 0.0, 100.0, round(rng.uniform(0, 100), 1)])
+        elif field == 'ram':
+            status.ram_total = rng.choice([0.9, 1.8, 3.7, 7.6])
+            status.ram_used = rng.uniform(0, status.ram_total)
+            status.ram_percent = status.ram_used / status.ram_total * 100
+        elif field == 'disk':
+            status.disk_total = rng.choice([14.6, 29.1, 58.2, 117.5, 234.0, 1800.0])
+            status.disk_used = round(rng.uniform(0, status.disk_total), 2)
+            status.disk_percent = round(status.disk_used / status.disk_total * 100, 2)
+        else:
+            status.ip = rng.choice(['DISCONNECT', '192.168.1.5', '10.0.0.123', '192.168.100.200'])
+    return status
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_matches_reference(font, seed):
+    rng = random.Random(seed)
+    temp_unit = 'FC'[seed % 2]
+    screen = StatsScreen(font, temp_unit)
+    status = None
+    for frame in range(150):
+        status = random_status(rng, status)
+        if rng.random() < 0.02:
+            screen.invalidate()
+        screen.render(status)
+        expected = pack_image(reference(status, temp_unit, font).tobytes(), 128, 64)
+        assert bytes(screen.canvas.buffer) == bytes(expected), 'frame %d' % frame
+
+
+def test_gauges_clamped(font):
+    screen = StatsScreen(font, 'C')
+    status = random_status(random.Random(0))
+    status.cpu_temp, status.cpu_usage = 130.0, 120.0
+    values = screen.values(status)
+    assert values['temp'][1] == 0 and values['cpu_gauge'] == 360
+    status.cpu_temp = -10.0
+    assert screen.values(status)['temp'][1] == 180
@@ -0,0 +1,20 @@
+import pytest
+
+from timing import Histogram, timer
+
+
+def test_quantile_interpolates_in_bucket():
+    hist = Histogram('test', buckets=(0.001, 0.01))
+    for value in (0.0002, 0.0004, 0.0006, 0.0008):
+        hist.observe(value)
+    # Within the first bucket, not its 1 ms bound
+    assert hist.quantile(0.5) == pytest.approx(0.0005)
+    assert hist.quantile(1.0) == pytest.approx(0.0008)
+    assert Histogram('empty').quantile(0.5) == 0.0
+
+
+def test_timer_observes_block():
+    hist = Histogram('test')
+    with timer(hist):
+        pass
+    assert hist.count == 1 and hist.sum >= 0
@@ -0,0 +1,43 @@
+from utils import Logger, INFO, WARNING
+
+
+def test_flush_writes_queued_lines(tmp_path):
+    logger = Logger(str(tmp_path / 'log'), stdout=False)
+    for i in range(300):
+        logger.write('line %d\n' % i)
+    logger.flush()
+    with open(logger.file) as f:
+        assert f.read().splitlines() == ['line %d' % i for i in range(300)]
+    logger.close()
+
+
+def test_levels():
+    logger = Logger('unused', level=WARNING)
+    assert logger.enabled('ERROR') and logger.enabled('WARNING')
+    assert not logger.enabled('INFO') and not logger.enabled('DEBUG')
+    logger.level = INFO
+    assert logger.enabled('INFO') and not logger.enabled('DEBUG')
+
+
+CRASH = '''
+import os, sys
+sys.path.insert(0, %r)
+import utils
+utils.logger.stdout = False
+utils.log('start', flush=True)
+utils.logger.capture_stderr()
+os.write(2, b'native crash message\\n')
+os.abort()
+'''
+
+def test_capture_stderr_keeps_output_before_a_crash(tmp_path):
+    import os
+    import sys
+    import subprocess
+    pi4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pi4')
+    env = dict(os.environ, PI4_DIR=str(tmp_path))
+    subprocess.run([sys.executable, '-c', CRASH % pi4], env=env, stderr=subprocess.DEVNULL)
+    with open(tmp_path / 'log') as f:
+        lines = f.read().splitlines()
+    assert lines[-1] == 'native crash message'
+    assert lines[0].endswith('[INFO] start')
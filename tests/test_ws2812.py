@@ -0,0 +1,9 @@
+import pytest
+
+from ws2812_RGB import FrameScheduler
+
+
+@pytest.mark.parametrize('fps', [0, -1])
+def test_frame_scheduler_rejects_fps(fps):
+    with pytest.raises(ValueError):
+        FrameScheduler(fps)